@@ -0,0 +1,31 @@
+"""Benchmark of the cold import time of the PMAC parser
+
+Each import is timed in a new interpreter, so nothing is already loaded.
+Run from the top of the repository: python benchmarks/benchmark_import.py
+"""
+
+import subprocess
+import sys
+
+MODULES = ['numpy', 'pygments.lexer', 'pmacparser.pmac_lexer', 'pmacparser.pmac_parser', 'pmacparser.pmac_highlight']
+REPEATS = 20
+
+TIMER = "import time; start = time.time(); import %s; print(time.time() - start)"
+
+
+def import_time(module):
+    """Return the shortest time taken to import the module in a new interpreter."""
+    times = []
+    for _ in range(REPEATS):
+        output = subprocess.check_output([sys.executable, '-c', TIMER % module])
+        times.append(float(output))
+    return min(times)
+
+
+def main():
+    for module in MODULES:
+        print('%-28s %7.1f ms' % (module, import_time(module) * 1000))
+
+
+if __name__ == '__main__':
+    main()
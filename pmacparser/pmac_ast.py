@@ -0,0 +1,464 @@
+"""PMAC Abstract Syntax Tree
+
+Statement and expression nodes for a parsed PMAC program
+"""
+
+from __future__ import division
+
+import operator
+
+import numpy as np
+
+
+def _divide(left, right):
+    """Return the quotient of the operands."""
+    return left / right
+
+
+def _bitwise_or(left, right):
+    """Return the bitwise OR of the integer parts of the operands."""
+    return np.bitwise_or(np.array(left).astype(int), np.array(right).astype(int))
+
+
+def _bitwise_xor(left, right):
+    """Return the bitwise XOR of the integer parts of the operands."""
+    return np.bitwise_xor(np.array(left).astype(int), np.array(right).astype(int))
+
+
+def _bitwise_and(left, right):
+    """Return the bitwise AND of the integer parts of the operands."""
+    return np.bitwise_and(np.array(left).astype(int), np.array(right).astype(int))
+
+
+BINARY_OPERATORS = {
+    '+': operator.add,
+    '-': operator.sub,
+    '|': _bitwise_or,
+    '^': _bitwise_xor,
+    '*': operator.mul,
+    '/': _divide,
+    '%': operator.mod,
+    '&': _bitwise_and,
+}
+
+COMPARATORS = {
+    '=': operator.eq,
+    '!=': operator.ne,
+    '>': operator.gt,
+    '!>': operator.le,
+    '<': operator.lt,
+    '!<': operator.ge,
+}
+
+# Maths functions as (numpy function, argument in degrees, result in degrees),
+# where the degree conversions only apply when I15 is 0
+MATH_FUNCTIONS = {
+    'SIN': (np.sin, True, False),
+    'COS': (np.cos, True, False),
+    'TAN': (np.tan, True, False),
+    'ASIN': (np.arcsin, False, True),
+    'ACOS': (np.arccos, False, True),
+    'ATAN': (np.arctan, False, True),
+    'ATAN2': (np.arctan2, False, True),
+    'SQRT': (np.sqrt, False, False),
+    'ABS': (np.abs, False, False),
+    'EXP': (np.exp, False, False),
+    'INT': (np.floor, False, False),
+    'LN': (np.log, False, False),
+}
+
+
+# Ways of running an IF whose array condition is not the same for all elements
+BRANCH_UNIFORM = 'uniform'  # Raise an exception
+BRANCH_MASKED = 'masked'  # Run both blocks, each only assigning to its own elements,
+# and run loops until the condition is false for every element
+BRANCH_PARTITIONED = 'partitioned'  # Run each block, or each loop iteration, on just the elements taking it
+BRANCH_AUTO = 'auto'  # Choose between masked and partitioned from the work that each would do
+
+
+def uniform_condition(condition, statement):
+    """Reduce a possibly numpy array condition to a single boolean.
+
+    Raise if the elements of an array condition do not all agree.
+    """
+    if isinstance(condition, (bool, np.bool_)):
+        # Scalar conditions are checked on every loop iteration, so skip the array reductions
+        return bool(condition)
+    if np.all(condition):
+        return True
+    elif not np.any(condition):
+        return False
+    raise Exception('%s conditions is an array with not all the same value' % statement)
+
+
+def split_condition(condition, mask):
+    """Split the active elements by an array condition.
+
+    Return the masks of the elements taking the THEN and the ELSE branches,
+    where a mask of None means that all elements are active.
+    """
+    if mask is None:
+        return condition, np.logical_not(condition)
+    return np.logical_and(mask, condition), np.logical_and(mask, np.logical_not(condition))
+
+
+def node_count(node):
+    """Return the number of nodes in a tree or block, as a measure of the work of evaluating it."""
+    if isinstance(node, tuple):
+        return sum(node_count(child) for child in node)
+    elif isinstance(node, Node):
+        return 1 + sum(node_count(getattr(node, name)) for name in node.fields)
+    return 0
+
+
+class Node(object):
+
+    """Base class of the syntax tree, nodes are not modified once built."""
+
+    __slots__ = ()
+
+    @property
+    def fields(self):
+        """Return the names of the children and values the node is built from, its slots unless it caches more."""
+        return self.__slots__
+
+    def __repr__(self):
+        """Return the node and its children as a string."""
+        return '%s(%s)' % (type(self).__name__,
+                           ', '.join(repr(getattr(self, name)) for name in self.fields))
+
+    def __eq__(self, other):
+        """Check for structural equality."""
+        return type(self) is type(other) and all(
+            getattr(self, name) == getattr(other, name) for name in self.fields)
+
+    def __ne__(self, other):
+        """Check for structural inequality."""
+        return not self == other
+
+    __hash__ = None
+
+    def __reduce__(self):
+        """Pickle the node as its type and children, which the type is called with to make it again."""
+        return type(self), tuple(getattr(self, name) for name in self.fields)
+
+
+class Constant(Node):
+
+    """A numeric literal."""
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def evaluate(self, variables):
+        """Return the value of the literal."""
+        return self.value
+
+
+class Variable(Node):
+
+    """A variable (I, M, P, Q) addressed by a literal number, e.g. P4801."""
+
+    __slots__ = ('var_type', 'number')
+
+    def __init__(self, var_type, number):
+        self.var_type = var_type
+        self.number = number
+
+    def address(self, variables):
+        """Return the number of the variable."""
+        return self.number
+
+    def evaluate(self, variables):
+        """Return the value of the variable."""
+        return variables.banks[self.var_type][self.number]
+
+
+class IndirectVariable(Node):
+
+    """A variable (I, M, P, Q) addressed by an expression, e.g. P(P1+1)."""
+
+    __slots__ = ('var_type', 'expression')
+
+    def __init__(self, var_type, expression):
+        self.var_type = var_type
+        self.expression = expression
+
+    def address(self, variables):
+        """Return the number of the variable."""
+        number = int(self.expression.evaluate(variables))
+        if not 0 <= number < len(variables.banks[self.var_type]):
+            raise IndexError('%s variable number out of range: %d' % (self.var_type, number))
+        return number
+
+    def evaluate(self, variables):
+        """Return the value of the variable."""
+        return variables.get_var(self.var_type, self.address(variables))
+
+
+class Negate(Node):
+
+    """A monadic minus."""
+
+    __slots__ = ('operand',)
+
+    def __init__(self, operand):
+        self.operand = operand
+
+    def evaluate(self, variables):
+        """Return the negated value of the operand."""
+        return -self.operand.evaluate(variables)
+
+
+class BinaryOperation(Node):
+
+    """An arithmetic or bitwise operation on two operands."""
+
+    __slots__ = ('operator', 'left', 'right')
+
+    def __init__(self, operator_text, left, right):
+        self.operator = operator_text
+        self.left = left
+        self.right = right
+
+    def evaluate(self, variables):
+        """Return the result of the operation."""
+        return BINARY_OPERATORS[self.operator](self.left.evaluate(variables), self.right.evaluate(variables))
+
+
+class MathFunction(Node):
+
+    """A call of one of the PMAC maths functions, e.g. SIN(P1)."""
+
+    __slots__ = ('function', 'argument')
+
+    def __init__(self, function, argument):
+        self.function = function
+        self.argument = argument
+
+    def evaluate(self, variables):
+        """Return the result of the function, honouring I15 for angles."""
+        function, degrees_in, degrees_out = MATH_FUNCTIONS[self.function]
+        value = self.argument.evaluate(variables)
+        if degrees_in and variables.get_i_variable(15) == 0:
+            value = np.radians(value)
+        if self.function == 'ATAN2':
+            # PMAC uses the value in Q0 as the cosine argument
+            result = function(value, variables.get_q_variable(0))
+        else:
+            result = function(value)
+        if degrees_out and variables.get_i_variable(15) == 0:
+            result = np.degrees(result)
+        return result
+
+
+class Comparison(Node):
+
+    """A comparison of two expressions within a condition."""
+
+    __slots__ = ('comparator', 'left', 'right')
+
+    def __init__(self, comparator, left, right):
+        self.comparator = comparator
+        self.left = left
+        self.right = right
+
+    def evaluate(self, variables):
+        """Return the result of the comparison."""
+        return COMPARATORS[self.comparator](self.left.evaluate(variables), self.right.evaluate(variables))
+
+
+class And(Node):
+
+    """The conjunction of two conditions."""
+
+    __slots__ = ('left', 'right')
+
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+
+    def evaluate(self, variables):
+        """Return the result of the conjunction."""
+        return np.logical_and(self.left.evaluate(variables), self.right.evaluate(variables))
+
+
+class Or(Node):
+
+    """The disjunction of two conditions."""
+
+    __slots__ = ('left', 'right')
+
+    def __init__(self, left, right):
+        self.left = left
+        self.right = right
+
+    def evaluate(self, variables):
+        """Return the result of the disjunction."""
+        return np.logical_or(self.left.evaluate(variables), self.right.evaluate(variables))
+
+
+class Assignment(Node):
+
+    """An assignment of an expression to a variable."""
+
+    __slots__ = ('target', 'expression')
+
+    def __init__(self, target, expression):
+        self.target = target
+        self.expression = expression
+
+    def execute(self, variables):
+        """Evaluate the expression and store it in the target variable."""
+        # The address is evaluated before the value, as the PMAC does
+        number = self.target.address(variables)
+        variables.set_var(self.target.var_type, number, self.expression.evaluate(variables))
+
+
+class If(Node):
+
+    """An IF block with an optional ELSE block.
+
+    The cost of each block is counted once as the node is built, for
+    choosing how to run the blocks with BRANCH_AUTO.
+    """
+
+    fields = ('condition', 'then_block', 'else_block')
+    __slots__ = fields + ('then_cost', 'else_cost')
+
+    def __init__(self, condition, then_block, else_block=()):
+        self.condition = condition
+        self.then_block = tuple(then_block)
+        self.else_block = tuple(else_block)
+        self.then_cost = node_count(self.then_block)
+        self.else_cost = node_count(self.else_block)
+
+    def execute(self, variables):
+        """Execute whichever block the condition selects.
+
+        With masked branches, elements of an array condition may differ and
+        each block is then run for the elements that take it.
+        """
+        condition = self.condition.evaluate(variables)
+        if variables.branches == BRANCH_UNIFORM:
+            if uniform_condition(condition, 'If'):
+                execute_block(self.then_block, variables)
+            else:
+                execute_block(self.else_block, variables)
+        else:
+            then_mask, else_mask = split_condition(condition, variables.mask)
+            if not np.any(else_mask):
+                execute_block(self.then_block, variables)
+            elif not np.any(then_mask):
+                execute_block(self.else_block, variables)
+            elif self.partitioned(variables, then_mask):
+                execute_partitioned(self.then_block, variables, then_mask)
+                execute_partitioned(self.else_block, variables, else_mask)
+            else:
+                execute_masked(self.then_block, variables, then_mask)
+                execute_masked(self.else_block, variables, else_mask)
+
+    def partitioned(self, variables, then_mask):
+        """Return true if the blocks should be run on partitions of the elements rather than under masks.
+
+        Masks evaluate both blocks for every element, partitions evaluate each
+        block for its own elements but have to gather and scatter the arrays.
+        """
+        if variables.branches != BRANCH_AUTO:
+            return variables.branches == BRANCH_PARTITIONED
+        then_fraction = np.count_nonzero(then_mask) / float(then_mask.size)
+        masked_cost = self.then_cost + self.else_cost
+        partitioned_cost = self.then_cost * then_fraction + self.else_cost * (1 - then_fraction) + \
+            2 * variables.array_count()
+        return partitioned_cost < masked_cost
+
+
+class While(Node):
+
+    """A WHILE loop.
+
+    The cost of the condition and body is counted once as the node is built,
+    for choosing how to run the iterations with BRANCH_AUTO.
+    """
+
+    fields = ('condition', 'body')
+    __slots__ = fields + ('iteration_cost',)
+
+    def __init__(self, condition, body):
+        self.condition = condition
+        self.body = tuple(body)
+        self.iteration_cost = node_count(self.condition) + node_count(self.body)
+
+    def execute(self, variables):
+        """Execute the body for as long as the condition holds.
+
+        Unless branches are uniform, elements of an array condition may differ.
+        The loop then runs while the condition holds for any element, and the
+        elements that have finished are either masked off from further
+        assignments, or left behind by running the following iterations on a
+        partition of the elements that are still running.
+        """
+        if variables.branches == BRANCH_UNIFORM:
+            while uniform_condition(self.condition.evaluate(variables), 'While'):
+                execute_block(self.body, variables)
+        else:
+            store = variables
+            mask = variables.mask
+            partitions = []
+            running, finished = split_condition(self.condition.evaluate(store), mask)
+            while np.any(running):
+                if np.any(finished):
+                    if self.partitioned(store, running):
+                        partitions.append((store, running))
+                        store = store.partition(running)
+                        mask = None
+                    else:
+                        mask = running
+                if mask is store.mask:
+                    execute_block(self.body, store)
+                else:
+                    execute_masked(self.body, store, mask)
+                running, finished = split_condition(self.condition.evaluate(store), mask)
+            # Scatter the results of each partition back, innermost first
+            for outer_store, outer_running in reversed(partitions):
+                outer_store.merge(store, outer_running)
+                store = outer_store
+
+    def partitioned(self, variables, running):
+        """Return true if the loop should carry on with a partition of the running elements rather than a mask.
+
+        A partition saves the work of the finished elements on every following
+        iteration, and is chosen once that saving on the next iteration alone
+        pays for gathering and scattering the array variables.
+        """
+        if variables.branches != BRANCH_AUTO:
+            return variables.branches == BRANCH_PARTITIONED
+        finished_fraction = 1 - np.count_nonzero(running) / float(running.size)
+        return self.iteration_cost * finished_fraction > 2 * variables.array_count()
+
+
+def execute_block(statements, variables):
+    """Execute a sequence of statements in order."""
+    for statement in statements:
+        statement.execute(variables)
+
+
+def execute_masked(statements, variables, mask):
+    """Execute a sequence of statements, only assigning to the elements selected by the mask."""
+    outer_mask = variables.mask
+    variables.mask = mask
+    try:
+        # Inactive elements are still calculated, and may be out of range of the functions
+        with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+            execute_block(statements, variables)
+    finally:
+        variables.mask = outer_mask
+
+
+def execute_partitioned(statements, variables, mask):
+    """Execute a sequence of statements on just the elements selected by the mask."""
+    partition = variables.partition(mask)
+    execute_block(statements, partition)
+    variables.merge(partition, mask)
@@ -0,0 +1,250 @@
+"""PMAC Backup
+
+Splitting of PMAC backup files into the kinematic and PLC programs they contain
+"""
+
+import mmap
+import os
+import re
+from collections import OrderedDict
+
+from pmacparser.pmac_lexer import ENCODING, SourceRegion
+from pmacparser.pmac_parser import PMACParser
+
+FORWARD = 'FORWARD'
+INVERSE = 'INVERSE'
+PLC = 'PLC'
+
+# Commands of the lines that select a coordinate system, and start and end the programs
+COORDINATE_SYSTEM_PATTERN = re.compile(r'&\s*(\d+)')
+OPEN_PATTERN = re.compile(r'\bOPEN\s*(?:(FORWARD|INVERSE)|PLC\s*(\d+))?')
+CLOSE_PATTERN = re.compile(r'\s*CLOSE\b')
+CLEAR_PATTERN = re.compile(r'\s*CLEAR\s*$')
+
+# Patterns for finding the same commands in the bytes of a whole file
+KEYWORD_PATTERN = re.compile(br'&|OPEN|CLOSE', re.IGNORECASE)
+CLEAR_LINE_PATTERN = re.compile(br'[^\S\n]*CLEAR[^\S\n]*(?:;[^\n]*)?(?:\n|\Z)', re.IGNORECASE)
+
+
+class ProgramBlock(object):
+
+    """A program from a backup file.
+
+    The program type is FORWARD or INVERSE for a kinematic program, with the
+    number of its coordinate system, or PLC with the number of the PLC. The
+    lines are those between the OPEN and CLOSE of the program, without any
+    CLEAR at the start. The line number of the first of them, and the offset
+    and length in bytes of all of them, locate the program in the file.
+
+    A program found in a memory mapped file has a source region of the map
+    instead of its lines, so that it is only decoded when it is lexed.
+    """
+
+    def __init__(self, program_type, number, lines, line, offset, length, region=None):
+        self.program_type = program_type
+        self.number = number
+        self.lines = lines
+        self.line = line
+        self.offset = offset
+        self.length = length
+        self.region = region
+
+    @property
+    def key(self):
+        """The program type and number, which identify the program in the backup."""
+        return self.program_type, self.number
+
+    @property
+    def source(self):
+        """The source of the program for the lexer, its lines or its region of a buffer."""
+        return self.lines if self.region is None else self.region
+
+    def parser(self, line_cache=None):
+        """Return a parser of the program, lexing it with the line cache if one is given."""
+        return PMACParser(self.source, line_cache)
+
+    def __repr__(self):
+        return 'ProgramBlock(%r, %r, line %d)' % (self.program_type, self.number, self.line)
+
+
+def split_backup(backup_file):
+    """Read a backup file opened in binary mode once, yielding each of the programs in it.
+
+    Other buffers, such as motion programs, are skipped, as is a program that
+    is not closed by the end of the file.
+    """
+    coordinate_system = 1
+    program = None
+    skipping = False
+    offset = 0
+    for line, raw_line in enumerate(backup_file, 1):
+        source_line = raw_line.decode(ENCODING).rstrip('\r\n')
+        code = source_line.split(';', 1)[0].upper()
+        if program is None and not skipping:
+            for match in COORDINATE_SYSTEM_PATTERN.finditer(code):
+                coordinate_system = int(match.group(1))
+            match = OPEN_PATTERN.search(code)
+            if match is not None:
+                if match.group(1) is not None:
+                    program = ProgramBlock(match.group(1), coordinate_system, [], line + 1,
+                                           offset + len(raw_line), 0)
+                elif match.group(2) is not None:
+                    program = ProgramBlock(PLC, int(match.group(2)), [], line + 1, offset + len(raw_line), 0)
+                else:
+                    skipping = True
+        elif CLOSE_PATTERN.match(code):
+            if program is not None:
+                yield program
+            program = None
+            skipping = False
+        elif program is not None:
+            if not program.lines and CLEAR_PATTERN.match(code):
+                # The CLEAR of the old program is not part of the program
+                program.line = line + 1
+                program.offset = offset + len(raw_line)
+            else:
+                program.lines.append(source_line)
+                program.length = offset + len(raw_line) - program.offset
+        offset += len(raw_line)
+
+
+def split_mapped_backup(buffer):
+    """Find each of the programs in a buffer holding a backup file, yielding them.
+
+    This finds the same programs as split_backup, but only the lines with the
+    commands that select a coordinate system or open and close a program are
+    decoded. The programs have their regions of the buffer instead of lines.
+    """
+    coordinate_system = 1
+    program = None
+    skipping = False
+    line = 1
+    counted = 0
+    position = 0
+    match = KEYWORD_PATTERN.search(buffer, position)
+    while match is not None:
+        line_start = buffer.rfind(b'\n', 0, match.start()) + 1
+        line_end = buffer.find(b'\n', match.end())
+        if line_end < 0:
+            line_end = len(buffer)
+        next_line = min(line_end + 1, len(buffer))
+        line += buffer[counted:line_start].count(b'\n')
+        counted = line_start
+        code = buffer[line_start:line_end].decode(ENCODING).rstrip('\r').split(';', 1)[0].upper()
+        if program is None and not skipping:
+            for command in COORDINATE_SYSTEM_PATTERN.finditer(code):
+                coordinate_system = int(command.group(1))
+            command = OPEN_PATTERN.search(code)
+            if command is not None:
+                if command.group(1) is not None:
+                    program = ProgramBlock(command.group(1), coordinate_system, None, line + 1, next_line, 0)
+                elif command.group(2) is not None:
+                    program = ProgramBlock(PLC, int(command.group(2)), None, line + 1, next_line, 0)
+                else:
+                    skipping = True
+                # The CLEAR of the old program is not part of the program
+                clear = program and CLEAR_LINE_PATTERN.match(buffer, program.offset)
+                while clear:
+                    program.offset = clear.end()
+                    program.line += 1
+                    clear = CLEAR_LINE_PATTERN.match(buffer, program.offset)
+        elif CLOSE_PATTERN.match(code):
+            if program is not None:
+                program.length = max(line_start - program.offset, 0)
+                program.region = SourceRegion(buffer, program.offset, program.offset + program.length)
+                yield program
+            program = None
+            skipping = False
+        position = next_line
+        match = KEYWORD_PATTERN.search(buffer, position)
+
+
+class BackupFile(object):
+
+    """A PMAC backup file, with an index of the programs it contains.
+
+    The index maps the key of each program to its line number, offset and
+    length, so that it can be read again without reading the rest of the
+    file. A program defined more than once is indexed where it was last
+    defined, as that is the one the controller keeps.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index = OrderedDict()
+
+    def programs(self):
+        """Read the file once, yielding each of the programs in it and filling in the index."""
+        self.index.clear()
+        for program in self.split():
+            self.index[program.key] = (program.line, program.offset, program.length)
+            yield program
+
+    def split(self):
+        """Read the file once, yielding each of the programs in it."""
+        with open(self.path, 'rb') as backup_file:
+            for program in split_backup(backup_file):
+                yield program
+
+    def build_index(self):
+        """Read the file once to fill in the index, returning the index."""
+        for _ in self.programs():
+            pass
+        return self.index
+
+    def read_program(self, program_type, number):
+        """Return the program of the type and number, reading just that part of the file."""
+        if not self.index:
+            self.build_index()
+        line, offset, length = self.index[program_type, number]
+        with open(self.path, 'rb') as backup_file:
+            backup_file.seek(offset)
+            text = backup_file.read(length).decode(ENCODING)
+        lines = [source_line.rstrip('\r') for source_line in text.split('\n')]
+        if lines and lines[-1] == '':
+            lines.pop()
+        return ProgramBlock(program_type, number, lines, line, offset, length)
+
+
+class MappedBackupFile(BackupFile):
+
+    """A PMAC backup file read through a memory map.
+
+    The file is never read into python strings as a whole. Finding the
+    programs only decodes the lines that open and close them, and each
+    program is lexed straight from its region of the map. The programs can
+    only be lexed until the file is closed.
+    """
+
+    def __init__(self, path):
+        super(MappedBackupFile, self).__init__(path)
+        self.file = open(path, 'rb')
+        if os.fstat(self.file.fileno()).st_size:
+            self.buffer = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        else:
+            # An empty file cannot be mapped
+            self.buffer = b''
+
+    def close(self):
+        """Close the memory map and the file."""
+        if isinstance(self.buffer, mmap.mmap):
+            self.buffer.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def split(self):
+        """Scan the map once, yielding each of the programs in it."""
+        return split_mapped_backup(self.buffer)
+
+    def read_program(self, program_type, number):
+        """Return the program of the type and number, with its region of the map."""
+        if not self.index:
+            self.build_index()
+        line, offset, length = self.index[program_type, number]
+        return ProgramBlock(program_type, number, None, line, offset, length,
+                            SourceRegion(self.buffer, offset, offset + length))
@@ -0,0 +1,47 @@
+"""PMAC Batch
+
+Lexing, parsing and compiling many PMAC programs at once across a pool of processes
+"""
+
+import multiprocessing
+from functools import partial
+
+from pmacparser.pmac_parser import PMACParser
+
+
+def compile_program(source, scalar=False):
+    """Lex, parse and compile one program, returning the compiled program or the error it raised.
+
+    The error is a ParserError, with the line number of the error, for a
+    syntax error, or the exception raised by the lexer for a token that is
+    not recognised.
+    """
+    try:
+        return PMACParser(source).compile(scalar)
+    except Exception as error:
+        return error
+
+
+def compile_programs(sources, processes=None, scalar=False, chunksize=None):
+    """Compile each of the program sources across a pool of processes, returning a list of the results.
+
+    The sources can be anything PMACParser takes that can be pickled, such
+    as lists of lines, strings or bytes. Each result is the compiled program,
+    or the error it raised, in the order of the sources, so one bad program
+    does not stop the rest. The pool has a process for each CPU unless
+    processes is given, and with one process the programs are compiled in
+    this process instead.
+    """
+    sources = list(sources)
+    compile_source = partial(compile_program, scalar=scalar)
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    processes = min(processes, len(sources))
+    if processes <= 1:
+        return [compile_source(source) for source in sources]
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(compile_source, sources, chunksize)
+    finally:
+        pool.close()
+        pool.join()
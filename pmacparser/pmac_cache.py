@@ -0,0 +1,139 @@
+"""PMAC Cache
+
+Cache of lexed, parsed and compiled PMAC programs kept in a directory, so they
+are not parsed again by the next process to use them
+"""
+
+import hashlib
+import marshal
+import os
+import pickle
+import sys
+import tempfile
+
+from pmacparser.pmac_codegen import CompiledProgram
+from pmacparser.pmac_parser import ProgramCache
+from pmacparser.pmac_program import Program
+from pmacparser.version import __version__
+
+# The entries of the cache are only read by the same version of the library and
+# python that wrote them, as compiled code and syntax trees differ between them
+CACHE_VERSION = (__version__, sys.version)
+
+# Each python keeps its own files, so processes running different pythons on
+# the same directory do not remove each other's entries as stale
+PYTHON_TAG = hashlib.sha1(sys.version.encode('utf-8')).hexdigest()[:8]
+
+
+def trusted(cache_file):
+    """Return true if the open file was written by this user, or root, and cannot be written by anyone else."""
+    if not hasattr(os, 'getuid'):
+        return True
+    status = os.fstat(cache_file.fileno())
+    return status.st_uid in (os.getuid(), 0) and not status.st_mode & 0o022
+
+
+class PersistentProgramCache(ProgramCache):
+
+    """A program cache which also keeps each program in a file in a directory.
+
+    A program that is not held in memory is read from its file, with one read,
+    before it is parsed again. The file holds the tokens, block table and
+    syntax tree of the program, and the code it has been compiled to, and is
+    written again when the program is first compiled. A file written by
+    another version of the library, or that cannot be read, is stale and is
+    removed. Each version of python keeps its own files.
+
+    Reading a file unpickles it, which can run any code, so only files owned
+    by the user running the process, or by root, that no one else can write
+    are read. The directory should still only be writable by trusted users.
+    The loads counts the programs read from files.
+    """
+
+    def __init__(self, directory, size=128):
+        super(PersistentProgramCache, self).__init__(size)
+        self.directory = directory
+        self.loads = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def clear(self):
+        """Drop all of the entries held in memory and reset the counters, leaving the files."""
+        super(PersistentProgramCache, self).clear()
+        self.loads = 0
+
+    def path(self, key):
+        """Return the path of the file of the program with the key."""
+        return os.path.join(self.directory, '%s-%s.pickle' % (key, PYTHON_TAG))
+
+    def get(self, key):
+        """Return the entry for the key, reading it from its file if it is not held."""
+        entry = super(PersistentProgramCache, self).get(key)
+        if entry is None:
+            entry = self.load(key)
+            if entry is not None:
+                self.loads += 1
+                super(PersistentProgramCache, self).put(key, entry)
+        return entry
+
+    def put(self, key, entry):
+        """Hold the entry for the key, and write it to its file."""
+        super(PersistentProgramCache, self).put(key, entry)
+        self.save(key, entry)
+
+    def compiled(self, key, entry):
+        """Write the entry of a program again, with the code it has been compiled to."""
+        self.save(key, entry)
+
+    def load(self, key):
+        """Return the entry read from the file of the program with the key, or None if there is none."""
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as cache_file:
+                if not trusted(cache_file):
+                    return None
+                data = cache_file.read()
+        except EnvironmentError:
+            return None
+        try:
+            version, entry = pickle.loads(data)
+            if version != CACHE_VERSION:
+                raise ValueError('Stale cache entry')
+            lexer, statements, error, starts, top_level, parsed_to, compiled_code = entry
+            program = Program(statements, error)
+            for scalar, (function_name, source, code) in compiled_code.items():
+                program.compiled_programs[scalar] = CompiledProgram(None, function_name, scalar, source,
+                                                                    marshal.loads(code))
+        except Exception:
+            # Anything that cannot be read is stale
+            self.remove(path)
+            return None
+        return lexer, program, starts, top_level, parsed_to
+
+    def save(self, key, entry):
+        """Write the entry to the file of the program with the key."""
+        lexer, program, starts, top_level, parsed_to = entry
+        compiled_code = dict((scalar, (compiled.function_name, compiled.source, marshal.dumps(compiled.code)))
+                             for scalar, compiled in program.compiled_programs.items())
+        data = pickle.dumps((CACHE_VERSION, (lexer, program.statements, program.error, starts, top_level, parsed_to,
+                                             compiled_code)),
+                            pickle.HIGHEST_PROTOCOL)
+        # Write to a temporary file that replaces the file, so a file is never read half written.
+        # The cache only saves time, so a program that cannot be written is just parsed again.
+        try:
+            handle, temporary_path = tempfile.mkstemp(dir=self.directory)
+        except EnvironmentError:
+            return
+        try:
+            with os.fdopen(handle, 'wb') as cache_file:
+                cache_file.write(data)
+            os.rename(temporary_path, self.path(key))
+        except EnvironmentError:
+            self.remove(temporary_path)
+
+    def remove(self, path):
+        """Remove a file from the cache directory, if it is there."""
+        try:
+            os.remove(path)
+        except EnvironmentError:
+            pass
@@ -0,0 +1,332 @@
+"""PMAC Code Generator
+
+Turns the syntax tree of a PMAC program into a native python function
+"""
+
+from __future__ import division
+
+import marshal
+import math
+import sys
+
+import numpy as np
+
+from pmacparser.pmac_ast import (Constant, Variable, IndirectVariable, Negate, BinaryOperation, MathFunction,
+                                 Comparison, And, Or, Assignment, If, While, MATH_FUNCTIONS, BINARY_OPERATORS,
+                                 uniform_condition)
+from pmacparser.pmac_variables import VARIABLE_TYPES, VARIABLE_COUNT, to_float, thread_context
+
+# Python operators for the comparisons and the arithmetic binary operations
+COMPARISON_OPERATORS = {'=': '==', '!=': '!=', '>': '>', '!>': '<=', '<': '<', '!<': '>='}
+ARITHMETIC_OPERATORS = ('+', '-', '*', '/', '%')
+
+# Maths functions whose numpy function returns an integer for an integer argument
+INTEGER_MATH_FUNCTIONS = ('ABS', 'INT')
+
+# Functions of the math module used for the maths functions by the scalar backend
+SCALAR_MATH_FUNCTIONS = {
+    'SIN': 'sin',
+    'COS': 'cos',
+    'TAN': 'tan',
+    'ASIN': 'asin',
+    'ACOS': 'acos',
+    'ATAN': 'atan',
+    'ATAN2': 'atan2',
+    'SQRT': 'sqrt',
+    'ABS': 'fabs',
+    'EXP': 'exp',
+    'INT': 'floor',
+    'LN': 'log',
+}
+
+
+def radians(value, i_variables):
+    """Convert an angle argument to radians unless I15 says it is in radians already."""
+    if i_variables[15] == 0:
+        return np.radians(value)
+    return value
+
+
+def degrees(value, i_variables):
+    """Convert an angle result to degrees unless I15 says it should be in radians."""
+    if i_variables[15] == 0:
+        return np.degrees(value)
+    return value
+
+
+def scalar_radians(value, i_variables):
+    """Convert a scalar angle argument to radians unless I15 says it is in radians already."""
+    if i_variables[15] == 0:
+        return math.radians(value)
+    return value
+
+
+def scalar_degrees(value, i_variables):
+    """Convert a scalar angle result to degrees unless I15 says it should be in radians."""
+    if i_variables[15] == 0:
+        return math.degrees(value)
+    return value
+
+
+def scalar_floor(value):
+    """Return the floor of a scalar as a float, as math.floor returns an int."""
+    return float(math.floor(value))
+
+
+def scalar_bitwise_or(left, right):
+    """Return the bitwise or of two scalars as a float."""
+    return float(int(left) | int(right))
+
+
+def scalar_bitwise_xor(left, right):
+    """Return the bitwise exclusive or of two scalars as a float."""
+    return float(int(left) ^ int(right))
+
+
+def scalar_bitwise_and(left, right):
+    """Return the bitwise and of two scalars as a float."""
+    return float(int(left) & int(right))
+
+
+SCALAR_OPERATORS = {'|': scalar_bitwise_or, '^': scalar_bitwise_xor, '&': scalar_bitwise_and}
+
+
+def is_scalar_input(variable_dict):
+    """Return true if all of the values in the input dictionary are python scalars."""
+    for value in variable_dict.values():
+        if not isinstance(value, (int, float)):
+            return False
+    return True
+
+
+def address(value, var_type):
+    """Return the number of an indirectly addressed variable."""
+    number = int(value)
+    if not 0 <= number < VARIABLE_COUNT:
+        raise IndexError('%s variable number out of range: %d' % (var_type, number))
+    return number
+
+
+class CodeGenerator(object):
+
+    """Generates the python source of a function from a PMAC syntax tree.
+
+    If scalar is true the function uses the math module and python floats
+    instead of numpy, so it only works for scalar variables.
+    """
+
+    def __init__(self, function_name='kin', scalar=False):
+        self.function_name = function_name
+        self.scalar = scalar
+        self.source_lines = []
+        self.indent = 0
+
+    def generate(self, statements):
+        """Return the source of a function of the P, Q, I and M variable banks running the statements."""
+        self.source_lines = []
+        self.indent = 0
+        # Constants keep their type, so integer constants must divide as floats do
+        self.emit('from __future__ import division')
+        self.emit('def %s(%s):' % (self.function_name, ', '.join(VARIABLE_TYPES)))
+        self.indent += 1
+        self.emit('%s = %s' % (', '.join('%sd' % var_type for var_type in VARIABLE_TYPES),
+                               ', '.join('%s.defined' % var_type for var_type in VARIABLE_TYPES)))
+        self.indent -= 1
+        self.block(statements)
+        return '\n'.join(self.source_lines) + '\n'
+
+    def emit(self, line):
+        """Add a line of source at the current indentation."""
+        self.source_lines.append('    ' * self.indent + line)
+
+    def block(self, statements):
+        """Add the source of an indented block of statements."""
+        self.indent += 1
+        if not statements:
+            self.emit('pass')
+        for statement in statements:
+            self.statement(statement)
+        self.indent -= 1
+
+    def statement(self, node):
+        """Add the source of a statement."""
+        if isinstance(node, Assignment):
+            value = self.expression(node.expression)
+            if not self.scalar and not self.is_numpy_float(node.expression):
+                value = '_to_float(%s)' % value
+            var_type = node.target.var_type
+            if isinstance(node.target, IndirectVariable):
+                # The address is evaluated before the value, as the PMAC does
+                self.emit('_number = _address(%s, %r)' % (self.expression(node.target.expression), var_type))
+                number = '_number'
+            else:
+                number = '%d' % node.target.number
+            self.emit('%s[%s] = %s' % (var_type, number, value))
+            self.emit('%sd.add(%s)' % (var_type, number))
+        elif isinstance(node, If):
+            self.emit(self.condition('if', node.condition, 'If'))
+            self.block(node.then_block)
+            if node.else_block:
+                self.emit('else:')
+                self.block(node.else_block)
+        elif isinstance(node, While):
+            self.emit(self.condition('while', node.condition, 'While'))
+            self.block(node.body)
+        else:
+            raise TypeError('Cannot generate code for %r' % (node,))
+
+    def condition(self, keyword, node, statement):
+        """Return the source of the line starting an if or while statement."""
+        if self.scalar:
+            return '%s %s:' % (keyword, self.expression(node))
+        return '%s _uniform(%s, "%s"):' % (keyword, self.expression(node), statement)
+
+    def expression(self, node):
+        """Return the source of an expression."""
+        if isinstance(node, Constant):
+            # The scalar backend only works with floats, so constants are converted here
+            result = repr(float(node.value)) if self.scalar else repr(node.value)
+        elif isinstance(node, Variable):
+            result = '%s[%d]' % (node.var_type, node.number)
+        elif isinstance(node, IndirectVariable):
+            result = '%s[_address(%s, %r)]' % (node.var_type, self.expression(node.expression), node.var_type)
+        elif isinstance(node, Negate):
+            result = '(-%s)' % self.expression(node.operand)
+        elif isinstance(node, BinaryOperation):
+            if node.operator in ARITHMETIC_OPERATORS:
+                result = '(%s %s %s)' % (self.expression(node.left), node.operator, self.expression(node.right))
+            else:
+                result = '_operators[%r](%s, %s)' % (node.operator, self.expression(node.left),
+                                                     self.expression(node.right))
+        elif isinstance(node, MathFunction):
+            result = self.math_function(node)
+        elif isinstance(node, Comparison):
+            result = '(%s %s %s)' % (self.expression(node.left), COMPARISON_OPERATORS[node.comparator],
+                                     self.expression(node.right))
+        elif isinstance(node, And):
+            if self.scalar:
+                result = '(%s and %s)' % (self.expression(node.left), self.expression(node.right))
+            else:
+                result = '_np.logical_and(%s, %s)' % (self.expression(node.left), self.expression(node.right))
+        elif isinstance(node, Or):
+            if self.scalar:
+                result = '(%s or %s)' % (self.expression(node.left), self.expression(node.right))
+            else:
+                result = '_np.logical_or(%s, %s)' % (self.expression(node.left), self.expression(node.right))
+        else:
+            raise TypeError('Cannot generate code for %r' % (node,))
+        return result
+
+    def math_function(self, node):
+        """Return the source of a maths function call, honouring I15 for angles."""
+        function, degrees_in, degrees_out = MATH_FUNCTIONS[node.function]
+        if self.scalar:
+            function_name = '_floor' if node.function == 'INT' else '_math.' + SCALAR_MATH_FUNCTIONS[node.function]
+        else:
+            function_name = '_np.' + function.__name__
+        value = self.expression(node.argument)
+        if degrees_in:
+            value = '_radians(%s, I)' % value
+        if node.function == 'ATAN2':
+            # PMAC uses the value in Q0 as the cosine argument
+            result = '%s(%s, Q[0])' % (function_name, value)
+        else:
+            result = '%s(%s)' % (function_name, value)
+        if degrees_out:
+            result = '_degrees(%s, I)' % result
+        return result
+
+    def is_numpy_float(self, node):
+        """Return true if the expression always evaluates to a numpy float.
+
+        Anything else is converted when it is stored, as the variables only
+        hold numpy floats.
+        """
+        if isinstance(node, (Variable, IndirectVariable)):
+            result = True
+        elif isinstance(node, MathFunction):
+            result = node.function not in INTEGER_MATH_FUNCTIONS or self.is_numpy_float(node.argument)
+        elif isinstance(node, Negate):
+            result = self.is_numpy_float(node.operand)
+        elif isinstance(node, BinaryOperation) and node.operator in ARITHMETIC_OPERATORS:
+            result = self.is_numpy_float(node.left) or self.is_numpy_float(node.right)
+        else:
+            result = False
+        return result
+
+
+class CompiledProgram(object):
+
+    """A PMAC program compiled to a native python function.
+
+    Calling it with an input dictionary of variables returns a dictionary
+    populated with the results of the program, as PMACParser.parse does.
+
+    A scalar program uses the math module on python floats, which is much
+    faster for a single point but raises ArithmeticError or ValueError
+    where numpy would return an infinity or a NaN.
+
+    A compiled program is pickled with its generated source and its code, so
+    that it can be sent between processes without being compiled again. The
+    source is only compiled again if it is unpickled by another version of
+    python, which cannot load the code.
+
+    The program holds no state of its own while it runs, so any number of
+    threads can run it at once, each with the variables of its own execution
+    context.
+    """
+
+    def __init__(self, statements, function_name='kin', scalar=False, source=None, code=None):
+        self.function_name = function_name
+        self.scalar = scalar
+        if source is None:
+            source = CodeGenerator(function_name, scalar).generate(statements)
+        self.source = source
+        if code is None:
+            code = compile(self.source, '<pmac %s>' % function_name, 'exec')
+        self.code = code
+        if scalar:
+            namespace = {
+                '_math': math,
+                '_floor': scalar_floor,
+                '_address': address,
+                '_radians': scalar_radians,
+                '_degrees': scalar_degrees,
+                '_operators': SCALAR_OPERATORS,
+            }
+        else:
+            namespace = {
+                '_np': np,
+                '_to_float': to_float,
+                '_address': address,
+                '_radians': radians,
+                '_degrees': degrees,
+                '_uniform': uniform_condition,
+                '_operators': BINARY_OPERATORS,
+            }
+        exec(self.code, namespace)
+        self.function = namespace[function_name]
+
+    def __call__(self, variable_dict, context=None):
+        """Run the program on a copy of the input dictionary, returning the result.
+
+        The program runs in the execution context given, or the context of
+        the calling thread.
+        """
+        if context is None:
+            context = thread_context()
+        variables = context.get_variables(self.scalar)
+        variables.populate_with_dict(variable_dict)
+        banks = variables.banks
+        self.function(banks['P'], banks['Q'], banks['I'], banks['M'])
+        return variables.to_dict()
+
+    def __reduce__(self):
+        return load_compiled_program, (self.function_name, self.scalar, self.source, sys.version,
+                                       marshal.dumps(self.code))
+
+
+def load_compiled_program(function_name, scalar, source, python_version, code):
+    """Return a compiled program unpickled from its source and the marshalled code of the python version given."""
+    code = marshal.loads(code) if python_version == sys.version else None
+    return CompiledProgram(None, function_name, scalar, source, code)
@@ -0,0 +1,52 @@
+"""PMAC Highlighting
+
+Pygments lexer for highlighting PMAC programs, using the rules of the PMAC lexer
+"""
+
+import re
+
+from pygments.lexer import RegexLexer
+from pygments.token import Punctuation, Whitespace, Error, Operator, Keyword, Name, Number, Comment
+
+from pmacparser.pmac_lexer import (TOKEN_RULES, TOKEN_WHITESPACE, TOKEN_CONDITIONAL, TOKEN_MATH, TOKEN_CONTROL,
+                                   TOKEN_VARIABLE_P, TOKEN_VARIABLE_Q, TOKEN_VARIABLE_I, TOKEN_VARIABLE_M,
+                                   TOKEN_CONSTANT_EXPRESSION, TOKEN_NUMBER, TOKEN_OPERATOR, TOKEN_PUNCTUATION,
+                                   TOKEN_INVALID_PLC)
+
+# The pygments token type of each type of PMAC token
+PYGMENTS_TOKEN_TYPES = {
+    TOKEN_WHITESPACE: Whitespace,
+    TOKEN_CONDITIONAL: Keyword.Conditional,
+    TOKEN_MATH: Keyword.Math,
+    TOKEN_CONTROL: Keyword.Control,
+    TOKEN_VARIABLE_P: Name.VariableP,
+    TOKEN_VARIABLE_Q: Name.VariableQ,
+    TOKEN_VARIABLE_I: Name.VariableI,
+    TOKEN_VARIABLE_M: Name.VariableM,
+    TOKEN_CONSTANT_EXPRESSION: Number.ConstantExpression,
+    TOKEN_NUMBER: Number,
+    TOKEN_OPERATOR: Operator,
+    TOKEN_PUNCTUATION: Punctuation,
+    TOKEN_INVALID_PLC: Error.InvalidPLC,
+}
+
+
+class PmacHighlightLexer(RegexLexer):
+
+    """Pygments lexer for PMAC programs.
+
+    The tokens are those of the PMAC lexer, with comments and tabs added so
+    that whole files can be highlighted.
+    """
+
+    name = 'pmac'
+    aliases = ['pmac']
+    filenames = ['*.pmc']
+    flags = re.MULTILINE | re.IGNORECASE
+
+    tokens = {
+        'root': [
+            (r';.*', Comment.Single),
+            (r'\t', Whitespace),
+        ] + [(pattern, PYGMENTS_TOKEN_TYPES[token_type]) for pattern, token_type in TOKEN_RULES]
+    }
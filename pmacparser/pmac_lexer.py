@@ -3,53 +3,264 @@
 Token class and lexer class for tokenising a PMAC program
 """
 
-from pygments.lexer import RegexLexer
-from pygments.token import Punctuation, Whitespace, Error, Operator, Keyword, Name, Number
+import re
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
+
+# Token types
+TOKEN_WHITESPACE = 'whitespace'
+TOKEN_CONDITIONAL = 'conditional'
+TOKEN_MATH = 'math'
+TOKEN_CONTROL = 'control'
+TOKEN_VARIABLE_P = 'variable_p'
+TOKEN_VARIABLE_Q = 'variable_q'
+TOKEN_VARIABLE_I = 'variable_i'
+TOKEN_VARIABLE_M = 'variable_m'
+TOKEN_CONSTANT_EXPRESSION = 'constant_expression'
+TOKEN_NUMBER = 'number'
+TOKEN_OPERATOR = 'operator'
+TOKEN_PUNCTUATION = 'punctuation'
+TOKEN_INVALID_PLC = 'invalid_plc'
+
+CONDITIONAL_KEYWORDS = ('IF', 'ELSE', 'ENDIF', 'ENDI', 'WHILE', 'ENDWHILE', 'ENDW', 'AND', 'OR')
+MATH_KEYWORDS = ('ABS', 'EXP', 'INT', 'LN', 'SIN', 'COS', 'TAN', 'ASIN', 'ACOS', 'ATAN2', 'ATAN', 'SQRT')
+CONTROL_KEYWORDS = ('RETURN', 'RET')
+OPERATORS = ('!=', '!<', '!>', '-', '+', '/', '\\', '*', '=', '<', '>', '^', '|', '&', '%')
+PUNCTUATION = ('(', ')')
+WHITESPACE = (' ', '\n', '\r')
+# Online commands that are not allowed in a PLC
+INVALID_PLC_COMMANDS = (
+    'DISABLE PLC', 'DIS PLC', 'DISABLE PLCC', 'DIS PLCC', 'DISPLAY', 'DISP', 'ENABLE PLC', 'ENA PLC', 'ENABLE PLCC',
+    'ENA PLCC', 'LOCK', 'MACROAUXREAD', 'MXR', 'MACROAUXWRITE', 'MXW', 'MACROMSTREAD', 'MMR', 'MACROMSTWRITE', 'MMW',
+    'MACROSLVREAD', 'MSR', 'MACROSLVWRITE', 'MSW', 'PAUSE PLC', 'PAU PLC', 'RESUME PLC', 'RES PLC', 'SETPHASE',
+    'UNLOCK')
+
+
+def alternatives(texts):
+    """Return a regular expression matching any of the texts, trying them in order."""
+    return '|'.join(re.escape(text) for text in texts)
+
+
+# The rule for each type of token, tried in order at each position in a line
+TOKEN_RULES = (
+    (alternatives(WHITESPACE), TOKEN_WHITESPACE),
+    (alternatives(CONDITIONAL_KEYWORDS), TOKEN_CONDITIONAL),
+    (alternatives(MATH_KEYWORDS), TOKEN_MATH),
+    (alternatives(CONTROL_KEYWORDS), TOKEN_CONTROL),
+    (r'P', TOKEN_VARIABLE_P),
+    (r'Q', TOKEN_VARIABLE_Q),
+    (r'I', TOKEN_VARIABLE_I),
+    (r'M', TOKEN_VARIABLE_M),
+    (r'\(\d+\+\d+\)', TOKEN_CONSTANT_EXPRESSION),
+    (r'\d+(?:\.\d+)?', TOKEN_NUMBER),
+    (alternatives(OPERATORS), TOKEN_OPERATOR),
+    (alternatives(PUNCTUATION), TOKEN_PUNCTUATION),
+    (alternatives(INVALID_PLC_COMMANDS), TOKEN_INVALID_PLC),
+)
+
+# All of the rules in one pattern, with a last rule matching any other character
+# so that every character of a line is part of a match
+TOKEN_PATTERN = re.compile('|'.join(pattern for pattern, token_type in TOKEN_RULES) + '|.', re.DOTALL)
+
+# The pattern for a whole program, which also matches the comment at the end of
+# a line, and the end of a line along with the white space either side of it
+TEXT_PATTERN = re.compile(r'[^\S\n]*;[^\n]*|[^\S\n]*\n[^\S\n]*|' + TOKEN_PATTERN.pattern, re.DOTALL)
+
+# Number of characters of a whole program scanned at a time
+CHUNK_SIZE = 65536
+
+# White space at the start of a line, other than the line end
+LEADING_SPACE_PATTERN = re.compile(r'[^\S\n]*')
+
+# Encoding of programs given as bytes. Anything that is not ASCII can only be in
+# a comment, and this decodes any byte without error.
+ENCODING = 'latin-1'
+
+# The type of decoded text, unicode on python 2 and str on python 3, and the
+# types of a whole program given as text or as bytes
+TEXT_TYPE = type(u'')
+STRING_TYPES = (TEXT_TYPE, str, bytes, bytearray)
+
+# Token kinds, small integers held in an array for each token. The texts that
+# always make the same token each have a kind of their own, so the parser can
+# check for a keyword or operator by comparing integers.
+KIND_END = 0
+KIND_WHITESPACE = 1
+KIND_NEWLINE = 2
+KIND_INTEGER = 3
+KIND_FLOAT = 4
+KIND_INVALID_PLC = 5
+VARIABLE_LETTERS = ('P', 'Q', 'I', 'M')
+KINDS = dict((text, kind) for kind, text in enumerate(
+    CONDITIONAL_KEYWORDS + MATH_KEYWORDS + CONTROL_KEYWORDS + VARIABLE_LETTERS + OPERATORS + PUNCTUATION,
+    KIND_INVALID_PLC + 1))
+
+# The kind of each token that always has the same text
+FIXED_TOKEN_KINDS = dict(KINDS)
+FIXED_TOKEN_KINDS.update((text, KIND_WHITESPACE) for text in WHITESPACE)
+FIXED_TOKEN_KINDS['\n'] = KIND_NEWLINE
+FIXED_TOKEN_KINDS.update((text, KIND_INVALID_PLC) for text in INVALID_PLC_COMMANDS)
+
+# Kinds of the tokens that open, divide or close a block
+BLOCK_KINDS = frozenset(KINDS[text] for text in ('IF', 'ELSE', 'ENDIF', 'ENDI', 'WHILE', 'ENDWHILE', 'ENDW'))
+
+
+def text_chunks(text, start=0, end=None):
+    """Yield the text from index start to index end, or the end of the text, decoded in chunks of whole lines.
+
+    Each chunk runs on from CHUNK_SIZE characters to the end of its line, so
+    only one chunk of a large buffer is decoded at a time.
+    """
+    newline = '\n' if isinstance(text, TEXT_TYPE) else b'\n'
+    if end is None:
+        end = len(text)
+    while start < end:
+        chunk_end = text.find(newline, start + CHUNK_SIZE, end)
+        chunk_end = end if chunk_end < 0 else chunk_end + 1
+        chunk = text[start:chunk_end]
+        if not isinstance(chunk, TEXT_TYPE):
+            chunk = chunk.decode(ENCODING)
+        yield chunk
+        start = chunk_end
+
+
+def kinds_pattern(kinds):
+    """Return a regular expression matching a token of any of the kinds in an array of token kinds."""
+    return re.compile(b'[' + re.escape(bytes(bytearray(sorted(kinds)))) + b']')
+
+
+# Patterns finding the tokens that open a block, and those that open, divide or
+# close one, in the array of token kinds without looking at the other tokens
+OPENING_PATTERN = kinds_pattern([KINDS['IF'], KINDS['WHILE']])
+BLOCK_PATTERN = kinds_pattern(BLOCK_KINDS)
+
+
+def shift_values(values, start, delta):
+    """Add delta to each of the values in an array of unsigned integers from index start on.
+
+    Numpy is only imported when this is called, as lexing does not need it.
+    """
+    if delta and start < len(values):
+        import numpy as np
+        np.frombuffer(values, dtype=np.int32)[start:] += delta
+
+
+class SourceRegion(object):
+
+    """A region of a buffer holding a program, such as a memory mapped file.
+
+    The lexer reads just the region from the buffer, a chunk at a time, so the
+    rest of the buffer is never copied or decoded.
+    """
+
+    def __init__(self, buffer, start, end):
+        self.buffer = buffer
+        self.start = start
+        self.end = end
+
+
+class LRUCache(object):
+
+    """A bounded cache, which drops the least recently used entry once it holds size entries.
+
+    The hits and misses are counted to show how well the cache suits the
+    programs it is used for.
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """Return the entry for the key, or None if it is not held."""
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            self.misses += 1
+        else:
+            # Move the entry to the most recently used end
+            self.entries[key] = entry
+            self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        """Hold the entry for the key."""
+        self.entries[key] = entry
+        self.resize(self.size)
+
+    def resize(self, size):
+        """Change the number of entries held, dropping the least recently used ones beyond it."""
+        self.size = size
+        while len(self.entries) > size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        """Drop all of the entries and reset the counters."""
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+class LineCache(LRUCache):
+
+    """A bounded cache of the tokens of lines, which can be shared by any number of lexers.
+
+    The kinds and texts of the tokens of a line are keyed by its code, with
+    any comment stripped and converted to upper case, so a line repeated
+    across programs is only split into tokens once.
+    """
+
+    def __init__(self, size=4096):
+        super(LineCache, self).__init__(size)
+
+
+def highlight_lexer():
+    """Return a pygments lexer for highlighting PMAC programs.
+
+    Pygments is only imported when this is called, as the PMAC lexer does not need it.
+    """
+    from pmacparser.pmac_highlight import PmacHighlightLexer
+    return PmacHighlightLexer()
 
 
 class PmacToken(object):
 
-    """Represents a PMAC token."""
+    """Represents a PMAC token.
+
+    The tokens are held in arrays by the lexer, and a token object is only made
+    when the parser takes one. The value of a number is converted by the lexer,
+    and is None for any other token.
+    """
 
-    def __init__(self, text=None):
-        self.line = ''
-        self.text = ''
-        self.type = ''
-        if text is not None:
-            self.text = text
+    __slots__ = ('text', 'line', 'kind', 'value')
 
-    def set(self, text, line):
-        """Set the value and line number of the token."""
+    def __init__(self, text='', line=0, kind=KIND_END, value=None):
         self.text = text
         self.line = line
+        self.kind = kind
+        self.value = value
 
     def is_int(self):
         """Return true if the token is an integer."""
-        return self.text.isdigit()
+        return self.kind == KIND_INTEGER
 
     def to_int(self):
         """Return the token as an integer."""
+        if self.kind == KIND_INTEGER:
+            return self.value
         return int(self.text)
 
     def is_float(self):
         """Return true if the token is a floating point number."""
-        result = True
-        if not self.is_int():
-            result = True
-            for char in self.text:
-                if char not in '0123456789.':
-                    result = False
-        return result
+        return self.kind == KIND_INTEGER or self.kind == KIND_FLOAT
 
     def to_float(self):
         """Return the token as a floating point number."""
-        if self.is_int():
-            result = self.to_int()
-        elif self.is_float():
-            result = float(self.text)
-        else:
+        if not self.is_float():
             raise Exception("Float expected, got: %s" % self, self)
-        return result
+        return self.value
 
     def __str__(self):
         """Return the token as a string."""
@@ -64,78 +275,365 @@ class PmacToken(object):
         return self.text != str(other)
 
 
-class PmacLexer(RegexLexer):
+class PmacLexer(object):
+
+    """Turn a list of strings into a PMAC Token list.
 
-    """Turn a list of strings into a PMAC Token list."""
+    The token list is held as arrays of the kind, the text and the line
+    number of each token. The text of a token is an index into a table of the
+    distinct texts, so repeated keywords, variable numbers and constants are
+    only stored once. Numbers are converted once, as they are added to the
+    table, and their values are held alongside the texts.
 
-    name = 'pmac'
-    aliases = ['pmac']
+    A line cache shared between lexers holds the tokens of the lines of
+    programs given as lists of lines, so that repeated lines are only split
+    into tokens once.
 
-    def __init__(self):
-        super(PmacLexer, self).__init__()
+    The block structure is held alongside the tokens, as offsets from each IF
+    or WHILE to its ELSE, or to the token closing it, and from each ELSE to
+    the token closing its block. The offsets move along with the tokens, so
+    changing some lines only updates the blocks open across the change.
+    """
+
+    def __init__(self, line_cache=None):
+        self.line_cache = line_cache
         self.line = 0
-        self.lexed_tokens = []
-        self.pygment_tokens = []
+        self.kinds = array('B')
+        self.text_ids = array('I')
+        self.lines = array('I')
+        self.texts = []
+        self.values = []
+        self.text_table = {}
         self.cur_token = 0
         self.token_list_length = 0
-
-    tokens = {
-        'root': [
-            (r'[ \n]', Whitespace),
-            (r'(IF|ELSE|ENDIF|ENDI|WHILE|ENDWHILE|ENDW|AND|OR)', Keyword.Conditional),
-            (r'(ABS|EXP|INT|LN|SIN|COS|TAN|ASIN|ACOS|ATAN2|ATAN|SQRT)', Keyword.Math),
-            (r'(RETURN|RET)', Keyword.Control),
-            (r'P', Name.VariableP),
-            (r'Q', Name.VariableQ),
-            (r'I', Name.VariableI),
-            (r'M', Name.VariableM),
-            (r'\(\d+\+\d+\)', Number.ConstantExpression),
-            (r'\d+(\.\d+)?', Number),
-            (r'\d+(\.\d+)?', Number),
-            (r'(!=)|(!<)|(!>)', Operator),
-            (r'[-+/\\*=<>^|&%]', Operator),
-            (r'[()]', Punctuation),
-            (r'(DISABLE PLC|DIS PLC|DISABLE PLCC|DIS PLCC|DISPLAY|DISP|ENABLE PLC|'
-             r'ENA PLC|ENABLE PLCC|ENA PLCC|LOCK|MACROAUXREAD|MXR|MACROAUXWRITE|MXW|'
-             r'MACROMSTREAD|MMR|MACROMSTWRITE|MMW|MACROSLVREAD|MSR|MACROSLVWRITE|MSW|'
-             r'PAUSE PLC|PAU PLC|RESUME PLC|RES PLC|SETPHASE|UNLOCK)', Error.InvalidPLC),
-        ]
-    }
+        self.block_offsets = array('i')
 
     def lex(self, source):
-        """Turn the source lines of code into the token list."""
+        """Turn the source code into the token list.
+
+        The source is a list of lines, or a whole program as a string, a bytes
+        buffer, a source region of a buffer or an open file. A whole program is
+        lexed in a single pass, with lines ending at each newline.
+        """
         self.line = 0
-        self.lexed_tokens = []
+        self.kinds = array('B')
+        self.text_ids = array('I')
+        self.lines = array('I')
+        self.texts = []
+        self.values = []
+        self.text_table = {}
         self.cur_token = 0
         self.token_list_length = 0
 
-        for source_line in source:
-            self.line += 1
-            # Strip comments from the ends of lines
-            code = source_line.split(';', 1)[0].strip().upper()
-            self.pygment_tokens = list(self.get_tokens(code))
+        if hasattr(source, 'read'):
+            source = source.read()
+        if isinstance(source, memoryview):
+            source = source.tobytes()
+        if isinstance(source, SourceRegion):
+            self.lex_text(source.buffer, source.start, source.end)
+        elif isinstance(source, STRING_TYPES):
+            self.lex_text(source)
+        else:
+            for line, source_line in enumerate(source, 1):
+                self.lex_line(source_line, line)
+                self.line = line
+
+        self.token_list_length = len(self.kinds)
+        self.match_blocks()
+
+    def update_lines(self, start, end, new_lines, outside=0):
+        """Replace the tokens of the lines from index start up to index end with those of the new lines.
+
+        Only the new lines are lexed. The tokens after them are moved to their
+        new line numbers and the block structure is resolved again around the
+        change. The blocks open across the change are searched for from the
+        token index outside, which must not be in any block, such as the start
+        of the top level statement holding the change. Return the index of the
+        first token replaced, the index after the last one and the number of
+        new tokens. If a new line has a token that is not recognised the tokens
+        are left as they were.
+        """
+        first = bisect_left(self.lines, start + 1)
+        last = bisect_left(self.lines, end + 1)
+        length = len(self.kinds)
+        try:
+            for line, source_line in enumerate(new_lines, start + 1):
+                self.lex_line(source_line, line)
+        except Exception:
+            del self.kinds[length:], self.text_ids[length:], self.lines[length:]
+            raise
+        kinds, text_ids, lines = self.kinds[length:], self.text_ids[length:], self.lines[length:]
+        del self.kinds[length:], self.text_ids[length:], self.lines[length:]
+        restructured = not BLOCK_KINDS.isdisjoint(self.kinds[first:last]) or not BLOCK_KINDS.isdisjoint(kinds)
+
+        open_blocks = []
+        if restructured or len(kinds) != last - first:
+            open_blocks = self.open_blocks(min(outside, first), first)
 
-            for pygment_token in self.pygment_tokens:
-                if pygment_token[0] == Error:
-                    raise Exception("Unrecognised Token: %s", str(pygment_token[1]))
-                if pygment_token[0] != Whitespace:
-                    token = PmacToken()
-                    token.set(pygment_token[1], self.line)
-                    token.type = pygment_token[0]
-                    self.lexed_tokens.append(token)
+        line_shift = len(new_lines) - (end - start)
+        shift_values(self.lines, last, line_shift)
+        self.kinds[first:last] = kinds
+        self.text_ids[first:last] = text_ids
+        self.lines[first:last] = lines
+        self.block_offsets[first:last] = array('i', [0]) * len(kinds)
+        self.line += line_shift
+        self.token_list_length = len(self.kinds)
+        self.update_blocks(first, last, len(kinds), restructured, open_blocks)
+        return first, last, len(kinds)
 
-            self.token_list_length = len(self.lexed_tokens)
+    def __getstate__(self):
+        """Return the state of the lexer to pickle, without its line cache.
+
+        The line cache is shared with other lexers, so it is left out.
+        """
+        state = self.__dict__.copy()
+        state['line_cache'] = None
+        return state
+
+    def copy(self):
+        """Return a copy of the lexer, with a token list of its own."""
+        lexer = PmacLexer(self.line_cache)
+        lexer.line = self.line
+        lexer.kinds = self.kinds[:]
+        lexer.text_ids = self.text_ids[:]
+        lexer.lines = self.lines[:]
+        lexer.texts = list(self.texts)
+        lexer.values = list(self.values)
+        lexer.text_table = dict(self.text_table)
+        lexer.token_list_length = self.token_list_length
+        lexer.block_offsets = self.block_offsets[:]
+        return lexer
+
+    def lex_line(self, source_line, line):
+        """Add the tokens of one line of a program, taking them from the line cache if it holds them."""
+        # Strip comments from the ends of lines
+        code = source_line.split(';', 1)[0].strip().upper()
+        line_cache = self.line_cache
+        if line_cache is None:
+            self.scan(code, line, TOKEN_PATTERN)
+            return
+        tokens = line_cache.get(code)
+        if tokens is None:
+            start = len(self.kinds)
+            # A line holding a line end is not cached, as its tokens are on more than one line
+            if self.scan(code, line, TOKEN_PATTERN) == line:
+                texts = self.texts
+                line_cache.put(code, (self.kinds[start:], tuple(texts[text_id] for text_id in self.text_ids[start:])))
+            return
+        kinds, texts = tokens
+        text_ids = list(map(self.text_table.get, texts))
+        if None in text_ids:
+            text_ids = [self.text_id(text, kind) for kind, text in zip(kinds, texts)]
+        self.text_ids.extend(text_ids)
+        self.kinds.extend(kinds)
+        self.lines.extend(array('I', [line]) * len(kinds))
+
+    def text_id(self, text, kind):
+        """Return the index of the text of a token of the kind in the table, adding the text if it is new."""
+        text_id = self.text_table.get(text)
+        if text_id is not None:
+            return text_id
+        text_id = self.text_table[text] = len(self.texts)
+        self.texts.append(text)
+        if kind == KIND_INTEGER:
+            self.values.append(int(text))
+        elif kind == KIND_FLOAT:
+            self.values.append(float(text))
+        else:
+            self.values.append(None)
+        return text_id
+
+    def lex_text(self, text, start=0, end=None):
+        """Add the tokens of a whole program in a string or a bytes buffer.
+
+        The text is scanned in chunks of whole lines, so that only one chunk at
+        a time is decoded, converted to upper case and split into tokens. Only
+        the text from index start to index end is lexed, to the end of the text
+        if end is None.
+        """
+        # White space is stripped from the start and end of the program, as it
+        # is from each line, and the rest is matched along with the line ends
+        if end is None:
+            end = len(text)
+        while end > start and text[end - 1:end].isspace():
+            end -= 1
+        line = 1
+        for chunk in text_chunks(text, start, end):
+            chunk = chunk[LEADING_SPACE_PATTERN.match(chunk).end():]
+            line = self.scan(chunk.upper(), line, TEXT_PATTERN)
+        self.line = line
+
+    def scan(self, code, line, pattern):
+        """Add the tokens of the code, starting on the line, and return the line it ends on."""
+        add_kind, add_text_id, add_line = self.kinds.append, self.text_ids.append, self.lines.append
+        text_table = self.text_table
+        fixed_token_kinds = FIXED_TOKEN_KINDS
+        for text in pattern.findall(code):
+            kind = fixed_token_kinds.get(text)
+            if kind is None:
+                # Anything else is a number, a constant expression, a comment, a line end
+                # or a character no rule matched
+                if text[0].isdigit():
+                    kind = KIND_FLOAT if '.' in text else KIND_INTEGER
+                elif text[0] == '(':
+                    # Evaluate a constant expression such as (4800+17) to a number
+                    text = str(sum(int(number) for number in text[1:-1].split('+')))
+                    kind = KIND_INTEGER
+                elif ';' in text:
+                    continue
+                elif '\n' in text:
+                    line += 1
+                    continue
+                else:
+                    raise Exception("Unrecognised Token: %s", text)
+            elif kind == KIND_WHITESPACE:
+                continue
+            elif kind == KIND_NEWLINE:
+                line += 1
+                continue
+            text_id = text_table.get(text)
+            if text_id is None:
+                text_id = self.text_id(text, kind)
+            add_kind(kind)
+            add_text_id(text_id)
+            add_line(line)
+        return line
+
+    @property
+    def lexed_tokens(self):
+        """The list of all of the tokens."""
+        return [self.token(index) for index in range(self.token_list_length)]
+
+    def token(self, index):
+        """Return the token at the index in the token list."""
+        text_id = self.text_ids[index]
+        return PmacToken(self.texts[text_id], self.lines[index], self.kinds[index], self.values[text_id])
+
+    @property
+    def blocks(self):
+        """The block table, mapping the index of each IF or WHILE token to the indices of its ELSE and closing token."""
+        return dict((match.start(), self.block(match.start())) for match in OPENING_PATTERN.finditer(self.kinds))
+
+    def block(self, index):
+        """Return the indices of the ELSE and of the token closing the block opened by the token at the index.
+
+        The ELSE index is None for a WHILE or an IF without an ELSE, and the
+        closing index is None for a block that is never closed.
+        """
+        offsets = self.block_offsets
+        offset = offsets[index]
+        if not offset:
+            return None, None
+        index += offset
+        if self.kinds[index] != KINDS['ELSE']:
+            return None, index
+        offset = offsets[index]
+        return index, index + offset if offset else None
+
+    def open_blocks(self, start, index):
+        """Return the indices of the tokens opening the blocks open at the token index, outermost first.
+
+        The tokens are searched from index start, which must not be in any
+        block, skipping over each block closed before the index.
+        """
+        open_blocks = []
+        match = OPENING_PATTERN.search(self.kinds, start, index)
+        while match is not None:
+            opening = match.start()
+            end_index = self.block(opening)[1]
+            if end_index is not None and end_index < index:
+                match = OPENING_PATTERN.search(self.kinds, end_index + 1, index)
+            else:
+                open_blocks.append(opening)
+                match = OPENING_PATTERN.search(self.kinds, opening + 1, index)
+        return open_blocks
+
+    def match_blocks(self):
+        """Resolve the block structure of the token list.
+
+        Fill in the block offsets, from each IF or WHILE token to its ELSE, or
+        to the token closing the block if it has no ELSE, and from each ELSE
+        to the token closing its block. The offset is zero where there is no
+        such token, as for a block that is never closed. Tokens that do not
+        close an open block are left out.
+        """
+        self.block_offsets = array('i', [0]) * len(self.kinds)
+        self.match_tokens(0, [], len(self.kinds))
+
+    def update_blocks(self, first, last, count, restructured, open_blocks):
+        """Resolve the block structure again after the tokens from index first to last were replaced.
+
+        The count new tokens only change the blocks around them if restructured
+        is true, as either they or the old tokens open, divide or close a block.
+        Otherwise the blocks in open_blocks, those open across the change, just
+        grow or shrink along with it. The offsets of the other blocks before
+        and after the change are unchanged, as they are within the blocks.
+        """
+        offsets = self.block_offsets
+        for index in open_blocks:
+            # Find the offset across the change, from the opening token or its ELSE
+            while offsets[index] and index + offsets[index] < first:
+                index += offsets[index]
+            if offsets[index]:
+                offsets[index] = 0 if restructured else offsets[index] + count - (last - first)
+        if restructured:
+            self.match_tokens(first, list(open_blocks), first + count)
+
+    def match_tokens(self, index, open_blocks, changed_end):
+        """Match the block tokens from the index on to the blocks they open, divide or close.
+
+        The offsets of each block are set as its tokens are matched, with
+        open_blocks as the stack of the blocks still open. The tokens from
+        index changed_end on were matched before, so each block they open is
+        skipped over whole, and matching stops once no block is left open.
+        """
+        kind_if, kind_while, kind_else = KINDS['IF'], KINDS['WHILE'], KINDS['ELSE']
+        endif_kinds = (KINDS['ENDIF'], KINDS['ENDI'])
+        endwhile_kinds = (KINDS['ENDWHILE'], KINDS['ENDW'])
+        kinds, offsets = self.kinds, self.block_offsets
+        search = BLOCK_PATTERN.search
+        match = search(kinds, index)
+        while match is not None:
+            index = match.start()
+            if index >= changed_end and not open_blocks:
+                break
+            kind = kinds[index]
+            if kind == kind_if or kind == kind_while:
+                if index >= changed_end:
+                    end_index = self.block(index)[1]
+                    if end_index is None:
+                        # Everything after is in a block that is never closed
+                        break
+                    match = search(kinds, end_index + 1)
+                    continue
+                open_blocks.append(index)
+            elif open_blocks:
+                opening = open_blocks[-1]
+                if kinds[opening] == kind_if:
+                    if kind == kind_else and not offsets[opening]:
+                        offsets[opening] = index - opening
+                        offsets[index] = 0
+                    elif kind in endif_kinds:
+                        # The offset to the closing token is from the ELSE if there is one
+                        divider = opening + offsets[opening]
+                        offsets[divider] = index - divider
+                        open_blocks.pop()
+                elif kind in endwhile_kinds:
+                    offsets[opening] = index - opening
+                    open_blocks.pop()
+            match = search(kinds, index + 1)
+
+    def peek_kind(self):
+        """Return the kind of the next token without taking it, or KIND_END at the end of the list."""
+        if self.cur_token < self.token_list_length:
+            return self.kinds[self.cur_token]
+        return KIND_END
 
     def get_token(self, should_be=None):
         """Return the first token and removes it from the list."""
         result = None
-        # Skip any newline tokens unless they are wanted
-        while self.cur_token < self.token_list_length and self.lexed_tokens[self.cur_token] == '\n':
-            self.line += 1
-            self.cur_token += 1
-        # Get the head token
         if self.cur_token < self.token_list_length:
-            result = self.lexed_tokens[self.cur_token]
+            result = self.token(self.cur_token)
             self.cur_token += 1
         # Is it the expected one
         if should_be is not None and not should_be == result:
@@ -147,10 +645,6 @@ class PmacLexer(RegexLexer):
         if token is not None:
             self.cur_token -= 1
 
-    def put_tokens(self, tokens):
-        """Put a  list of tokens back on to the list"""
-        self.cur_token -= len(tokens)
-
     def reset(self):
         """Reset the lexer back to the beginning of the list"""
         self.cur_token = 0
@@ -3,10 +3,37 @@
 Library for parsing and running PMAC programs
 """
 
-import numpy as np
-
-from pygments.token import Number
-from pmacparser.pmac_lexer import PmacLexer
+import hashlib
+import re
+from array import array
+from bisect import bisect_left, bisect_right
+
+from pmacparser.pmac_lexer import (PmacLexer, LRUCache, SourceRegion, KINDS, KIND_INTEGER, KIND_FLOAT, ENCODING,
+                                   TEXT_TYPE, STRING_TYPES, shift_values, text_chunks)
+from pmacparser.pmac_ast import (Constant, Variable, IndirectVariable, Negate, BinaryOperation, MathFunction,
+                                 Comparison, And, Or, Assignment, If, While, MATH_FUNCTIONS, BRANCH_UNIFORM,
+                                 BRANCH_AUTO)
+from pmacparser.pmac_program import Program, CHUNK_SIZE
+from pmacparser.pmac_variables import Variables, VARIABLE_COUNT, thread_context
+
+# Kinds of the tokens the parser looks for
+KIND_IF, KIND_ELSE, KIND_WHILE, KIND_AND, KIND_OR, KIND_P, KIND_Q, KIND_I, KIND_M = (
+    KINDS[text] for text in ('IF', 'ELSE', 'WHILE', 'AND', 'OR', 'P', 'Q', 'I', 'M'))
+KIND_ASSIGN, KIND_OPEN, KIND_CLOSE, KIND_MINUS = (KINDS[text] for text in ('=', '(', ')', '-'))
+ENDIF_KINDS = frozenset(KINDS[text] for text in ('ENDIF', 'ENDI'))
+ENDWHILE_KINDS = frozenset(KINDS[text] for text in ('ENDWHILE', 'ENDW'))
+RETURN_KINDS = frozenset(KINDS[text] for text in ('RETURN', 'RET'))
+VARIABLE_KINDS = frozenset((KIND_P, KIND_Q, KIND_I, KIND_M))
+NUMBER_KINDS = frozenset((KIND_INTEGER, KIND_FLOAT))
+SUM_OPERATOR_KINDS = frozenset(KINDS[text] for text in ('+', '-', '|', '^'))
+PRODUCT_OPERATOR_KINDS = frozenset(KINDS[text] for text in ('*', '/', '%', '&'))
+SIGN_KINDS = frozenset(KINDS[text] for text in ('+', '-'))
+COMPARATOR_KINDS = frozenset(KINDS[text] for text in ('=', '!=', '>', '!>', '<', '!<'))
+MATH_FUNCTION_KINDS = frozenset(KINDS[function] for function in MATH_FUNCTIONS)
+
+# Comments, and white space at the ends of lines, are left out of the text a
+# program is keyed by in the program cache
+COMMENT_PATTERN = re.compile(r'[^\S\n]*;[^\n]*|[^\S\n]+$', re.MULTILINE)
 
 
 class ParserError(Exception):
@@ -16,426 +43,466 @@ class ParserError(Exception):
     def __init__(self, message, token):
         super(ParserError, self).__init__()
         self.message = message
-        self.line = token.line
+        self.line = getattr(token, 'line', None)
 
     def __str__(self):
         return '[Line %s] %s' % (self.line, self.message)
 
+    def __reduce__(self):
+        return ParserError, (self.message, None), {'line': self.line}
 
-class Variables(object):
 
-    """Represents a PMAC Variable (I, M, P, Q)."""
+def program_key(source):
+    """Return the source, with any file read, and a hash of its text to key it by in the program cache.
 
-    def __init__(self):
-        self.variable_dict = {}
+    The text has its comments and the white space at the ends of its lines
+    stripped, and is converted to upper case, as the lexer does, so programs
+    that only differ in those make the same tokens and have the same key. A
+    whole program is hashed a chunk of lines at a time, as the lexer reads it,
+    so a large buffer is never decoded all at once. Lines given by an
+    iterator are returned as a list, as hashing them uses up the iterator.
+    """
+    if hasattr(source, 'read'):
+        source = source.read()
+    if isinstance(source, memoryview):
+        source = source.tobytes()
+    # Lines are lexed one at a time, so they are not keyed the same as the text of the whole program.
+    # The type of the source is hashed before the text, as comments are stripped from the text.
+    if isinstance(source, SourceRegion):
+        key = hashlib.sha1(b'text\n')
+        chunks = text_chunks(source.buffer, source.start, source.end)
+    elif isinstance(source, STRING_TYPES):
+        key = hashlib.sha1(b'text\n')
+        chunks = text_chunks(source)
+    else:
+        source = list(source)
+        key = hashlib.sha1(b'lines\n')
+        chunks = ['\n'.join(source)]
+    for chunk in chunks:
+        if not isinstance(chunk, TEXT_TYPE):
+            chunk = chunk.decode(ENCODING)
+        key.update(COMMENT_PATTERN.sub('', chunk).upper().encode('utf-8'))
+    return source, key.hexdigest()
+
+
+class ProgramCache(LRUCache):
+
+    """A bounded cache of lexed and parsed programs, keyed by a hash of their text.
+
+    Parsers of a program that is held share its tokens and syntax tree, and
+    the code it is compiled to, so making one costs little more than hashing
+    the program.
+    """
 
-    def get_i_variable(self, var_num):
-        """Return the value of the specified I variable."""
-        return self.get_var('I', var_num)
+    def __init__(self, size=128):
+        super(ProgramCache, self).__init__(size)
 
-    def get_p_variable(self, var_num):
-        """Return the value of the specified P variable."""
-        return self.get_var('P', var_num)
+    def compiled(self, key, entry):
+        """Note that a program held has been compiled, adding to the compiled programs of its Program.
 
-    def get_q_variable(self, var_num):
-        """Return the value of the specified Q variable."""
-        return self.get_var('Q', var_num)
+        The entry is held itself, so there is nothing to do here.
+        """
 
-    def get_m_variable(self, var_num):
-        """Return the value of the specified M variable."""
-        return self.get_var('M', var_num)
 
-    def set_i_variable(self, var_num, value):
-        """Set the value of the specified I variable."""
-        self.set_var('I', var_num, value)
+# The program cache used by parsers unless they are given another one, or None
+PROGRAM_CACHE = ProgramCache()
 
-    def set_p_variable(self, var_num, value):
-        """Set the value of the specified P variable."""
-        self.set_var('P', var_num, value)
 
-    def set_q_variable(self, var_num, value):
-        """Set the value of the specified Q variable."""
-        self.set_var('Q', var_num, value)
+class PMACParser(object):
 
-    def set_m_variable(self, var_num, value):
-        """Set the value of the specified M variable."""
-        self.set_var('M', var_num, value)
+    """Parses a PMAC program, and runs an emulator for forward kinematic programs
 
-    def get_var(self, var_type, var_num):
-        """Return the value of the specified variable type and number."""
-        addr = '%s%s' % (var_type, var_num)
-        if addr in self.variable_dict:
-            result = self.variable_dict[addr]
+    Uses the PMAC Lexer to tokenise a list of strings, or a whole program as a
+    string, bytes buffer or open file, and then parses the tokens once into a
+    syntax tree of statements and expressions. The tree is evaluated
+    using an input dictionary or variables, populating a dictionary with the
+    results of the program operations. A line cache shared by the parsers of
+    many programs saves lexing their repeated lines again. Programs are held in
+    a program cache once parsed, so making a parser of the same program again
+    reuses its tokens, syntax tree and compiled code. The parsed program is
+    held in a Program, which any number of threads can run at once.
+    It is a modification of the dls_pmacanalyse code developed by J Thompson.
+    """
+
+    def __init__(self, program_lines, line_cache=None, program_cache=PROGRAM_CACHE):
+        self.program_key = None
+        self.program_cache = program_cache
+        if program_cache is not None:
+            program_lines, self.program_key = program_key(program_lines)
+        self.lines = program_lines
+        if program_cache is not None:
+            entry = program_cache.get(self.program_key)
+            if entry is not None:
+                self.lexer, self.program, self.starts, self.top_level, self.parsed_to = entry
+                return
+        self.lexer = PmacLexer(line_cache)
+        self.lexer.lex(program_lines)
+        # The token index each top level statement starts at, the statement parsed
+        # from there, None for one with no effect, and the index the parse reached
+        self.starts = array('I')
+        self.top_level = []
+        self.parsed_to = 0
+        # The whole program is parsed here, so a syntax error anywhere in it, even in
+        # a branch that would never run, fails every run. It is raised by the runs
+        # rather than here, so that making a parser of a bad program still works.
+        try:
+            self.program = Program(self.parseProgram())
+        except ParserError as error:
+            self.program = Program((), error)
+        self.lexer.reset()
+        if program_cache is not None:
+            program_cache.put(self.program_key, self.cache_entry())
+
+    def cache_entry(self):
+        """Return the entry of the program in the program cache, the parts shared by its parsers."""
+        return self.lexer, self.program, self.starts, self.top_level, self.parsed_to
+
+    @property
+    def statements(self):
+        """The syntax trees of the top level statements of the program."""
+        return self.program.statements
+
+    @property
+    def error(self):
+        """The syntax error that stopped the program being parsed, or None."""
+        return self.program.error
+
+    @property
+    def variable_dict(self):
+        """The numpy variables of the execution context of the calling thread, as its last run left them."""
+        return thread_context().get_variables()
+
+    def update_lines(self, start, end, new_lines):
+        """Replace the program lines from index start up to index end with the new lines.
+
+        Only the new lines are lexed. The program is parsed again from the top
+        level statement before the first changed token, as that statement could
+        run on into the change, until it reaches the start of a statement after
+        the change, and the rest of the syntax tree is reused from there.
+        """
+        if self.program_key is not None:
+            # The tokens are shared with the other parsers of the program in the program cache
+            self.lexer = self.lexer.copy()
+            self.program_key = None
+        # The start of the top level statement holding the change is outside of every block,
+        # as is the start of a statement that did not parse
+        first = bisect_left(self.lexer.lines, start + 1)
+        outside = self.starts[bisect_right(self.starts, first) - 1] if self.starts and self.starts[0] <= first else 0
+        if self.parsed_to <= first and self.parsed_to < self.lexer.token_list_length:
+            outside = self.parsed_to
+        first, last, count = self.lexer.update_lines(start, end, new_lines, outside)
+        if isinstance(self.lines, (list, tuple)):
+            self.lines = list(self.lines[:start]) + list(new_lines) + list(self.lines[end:])
         else:
-            result = 0
-        npvalue = np.array(result)
-        return npvalue.astype(float)
+            # The lines of the program are not known for any other source
+            self.lines = None
+
+        old_starts, old_top_level, old_parsed_to = self.starts, self.top_level, self.parsed_to
+        position = max(bisect_left(old_starts, first) - 1, 0)
+        self.starts = old_starts[:position]
+        self.top_level = old_top_level[:position]
+        self.lexer.cur_token = old_starts[position] if position < len(old_starts) else 0
+        try:
+            self.parseStatements((old_starts, old_top_level, old_parsed_to, first + count, count - (last - first)))
+            self.program = Program(tuple(filter(None, self.top_level)))
+        except ParserError as error:
+            self.program = Program((), error)
+        self.lexer.reset()
 
-    def set_var(self, var_type, var_num, value):
-        """Set the value of the variable type and number with the value specified."""
-        addr = '%s%s' % (var_type, var_num)
-        self.variable_dict[addr] = value
+    def parse(self, variable_dict, branches=BRANCH_UNIFORM):
+        """Run the kinematic program on a copy of the input dictionary, returning the result.
 
-    def populate_with_dict(self, dictionary):
-        """Copy the input dictionary into the local variable dictionary."""
-        self.variable_dict = dictionary.copy()
+        When the inputs are numpy arrays, an IF or WHILE condition may differ
+        between elements. By default that raises an exception, with branches
+        set to BRANCH_MASKED or BRANCH_PARTITIONED each element takes its own
+        branch, or runs its own number of loop iterations, instead. Masked
+        branches calculate every block for all of the elements, partitioned
+        branches gather the elements taking a block and calculate it just for
+        those. BRANCH_AUTO chooses whichever should be quicker each time.
 
-    def to_dict(self):
-        """Return the variables as a dictionary."""
-        return self.variable_dict
+        When all of the inputs are python scalars the program is run by the
+        scalar backend, falling back to numpy if a calculation is out of the
+        range of the math module.
 
+        Any number of threads can run the program at once, as each runs it
+        with the variables of its own execution context.
+        """
+        return self.program.run(variable_dict, branches)
 
-class PMACParser(object):
+    def parse_many(self, variable_dicts, branches=BRANCH_AUTO, columnar=False):
+        """Run the kinematic program on each of the input dictionaries, returning a list of the results.
 
-    """Parses a PMAC program, and runs an emulator for forward kinematic programs
+        The inputs are stacked into arrays and the program is run on them all
+        at once, as described for Program.run_many. If columnar is true the
+        result is one dictionary holding an array of the values of each
+        variable for all of the inputs.
+        """
+        return self.program.run_many(variable_dicts, branches, columnar)
 
-    Uses the PMAC Lexer to tokenise a list of strings, and then parses the tokens,
-    using an input dictionary or variables to evaluate the expressions in the code,
-    populating a dictionary with the results of the program operations.
-    It is a modification of the dls_pmacanalyse code developed by J Thompson.
-    """
+    def parse_chunked(self, variable_dict, outputs=None, directory=None, chunk_size=CHUNK_SIZE, branches=BRANCH_AUTO):
+        """Run the kinematic program on input arrays chunk by chunk, returning a dictionary of the output arrays.
 
-    def __init__(self, program_lines):
-        self.lexer = PmacLexer()
-        self.lines = program_lines
-        self.lexer.lex(self.lines)
-        self.variable_dict = Variables()
-        self.if_level = 0
-        self.while_level = 0
-        self.while_dict = {}
-        self.pre_process()
-
-    def pre_process(self):
-        """Evaluate and replace any Constants Expressions (e.g. 4800+17)."""
-        token = self.lexer.get_token()
-        while token is not None:
-            if token.type == Number.ConstantExpression:
-                token_text = str(token)
-                token_text = token_text.replace("(", "")
-                token_text = token_text.replace(")", "")
-                tokens = token_text.split("+")
-                int1 = int(tokens[0])
-                int2 = int(tokens[1])
-                val = int1 + int2
-                token.set(str(val), token.line)
-                token.type = Number
-
-            token = self.lexer.get_token()
-        self.lexer.reset()
+        The inputs can be memory mapped arrays larger than memory, as only
+        chunk_size elements of them are run at a time, as described for
+        Program.run_chunked. The results are written into the arrays given in
+        outputs, or into new .npy files in the directory if one is given.
+        """
+        return self.program.run_chunked(variable_dict, outputs, directory, chunk_size, branches)
 
-    def parse(self, variable_dict):
-        """Top level kinematic program parser."""
-        self.variable_dict.populate_with_dict(variable_dict)
+    def compile(self, scalar=False):
+        """Return the program compiled to a native python function.
 
+        The function takes an input dictionary of variables and returns the
+        populated dictionary, in the same way as parse. If scalar is true the
+        function uses the math module and only works for scalar inputs.
+        """
+        compiled_before = scalar in self.program.compiled_programs
+        compiled = self.program.compile(scalar)
+        if not compiled_before and self.program_key is not None:
+            # The program cache may keep the compiled code, as a persistent cache does
+            self.program_cache.compiled(self.program_key, self.cache_entry())
+        return compiled
+
+    def expect_token(self, should_be):
+        """Take the next token, which must be the one specified."""
         token = self.lexer.get_token()
-        while token is not None:
-            if token == 'Q':
-                self.parseQ()
-            elif token == 'P':
-                self.parseP()
-            elif token == 'I':
-                self.parseI()
-            elif token == 'M':
-                self.parseM()
-            elif token == 'IF':
-                self.parseIf()
-            elif token == 'ELSE':
-                self.parseElse(token)
-            elif token in ('ENDIF', 'ENDI'):
-                self.parseEndIf(token)
-            elif token == 'WHILE':
-                self.parseWhile(token)
-            elif token in ('ENDWHILE', 'ENDW'):
-                self.parseEndWhile(token)
-            elif token in ('RETURN', 'RET'):
-                self.parseReturn(token)
-            else:
-                raise ParserError('Unexpected token: %s' % token, token)
-            token = self.lexer.get_token()
+        if token is None or token.kind != KINDS[should_be]:
+            raise ParserError('Expected %s, got %s' % (should_be, token), token)
+        return token
 
-        self.lexer.reset()
-        return self.variable_dict.to_dict()
+    def variable(self, var_type):
+        """Take the number of a variable of the type, returning the variable."""
+        token = self.lexer.get_token()
+        number = token.to_int()
+        if number >= VARIABLE_COUNT:
+            raise ParserError('%s variable number out of range: %d' % (var_type, number), token)
+        return Variable(var_type, number)
+
+    def parseProgram(self):
+        """Parse the whole token list, returning the top level statements."""
+        self.starts = array('I')
+        self.top_level = []
+        self.parseStatements()
+        return tuple(filter(None, self.top_level))
+
+    def parseStatements(self, previous=None):
+        """Parse the top level statements from the current token to the end of the program.
+
+        Each statement is added to the top level statements along with the
+        index of its first token. When a change is parsed again, previous holds
+        the starts, statements and parsed_to of the parse before the change,
+        the index of the first token after the change and the change in the
+        number of tokens. Once a statement would start where one did before
+        the change the rest of the previous parse is used.
+        """
+        lexer = self.lexer
+        end = lexer.token_list_length
+        while lexer.cur_token < end:
+            start = lexer.cur_token
+            if previous is not None and start >= previous[3]:
+                old_starts, old_top_level, old_parsed_to, changed_end, shift = previous
+                position = bisect_left(old_starts, start - shift)
+                if position < len(old_starts) and old_starts[position] == start - shift:
+                    count = len(self.starts)
+                    self.starts.extend(old_starts[position:])
+                    shift_values(self.starts, count, shift)
+                    self.top_level.extend(old_top_level[position:])
+                    # Go on from any statement that did not parse before
+                    lexer.cur_token = old_parsed_to + shift
+                    previous = None
+                    continue
+            self.parsed_to = start
+            statement = self.parseStatement(lexer.get_token())
+            self.starts.append(start)
+            self.top_level.append(statement)
+        self.parsed_to = end
+
+    def parseBlock(self, end):
+        """Parse the statements before the token index end, or up to the end of the program if end is None."""
+        if end is None:
+            end = self.lexer.token_list_length
+        statements = []
+        while self.lexer.cur_token < end:
+            statement = self.parseStatement(self.lexer.get_token())
+            if statement is not None:
+                statements.append(statement)
+        if self.lexer.cur_token > end:
+            # A statement ran on into the token closing the block
+            token = self.lexer.token(end)
+            raise ParserError('Unexpected %s' % token, token)
+        return tuple(statements)
+
+    def parseStatement(self, token):
+        """Parse the statement starting with the token, returning None if it has no effect."""
+        kind = token.kind
+        if kind == KIND_Q:
+            statement = self.parseQ()
+        elif kind == KIND_P:
+            statement = self.parseP()
+        elif kind == KIND_I:
+            statement = self.parseI()
+        elif kind == KIND_M:
+            statement = self.parseM()
+        elif kind == KIND_IF:
+            statement = self.parseIf()
+        elif kind == KIND_WHILE:
+            statement = self.parseWhile(token)
+        elif kind in RETURN_KINDS:
+            statement = self.parseReturn(token)
+        elif kind == KIND_ELSE:
+            raise ParserError('Unexpected ELSE', token)
+        elif kind in ENDIF_KINDS:
+            raise ParserError('Unexpected ENDIF/ENDI', token)
+        elif kind in ENDWHILE_KINDS:
+            raise ParserError('Unexpected ENDWHILE/ENDW', token)
+        else:
+            raise ParserError('Unexpected token: %s' % token, token)
+        return statement
+
+    def parseAssignment(self, target):
+        """Parse the rest of an assignment to the target, or nothing if the variable is just reported."""
+        if self.lexer.peek_kind() == KIND_ASSIGN:
+            self.lexer.get_token()
+            return Assignment(target, self.parseExpression())
+        # Report variable values (do nothing)
+        return None
 
     def parseM(self):
         """Parse an M expression - typically an assignment."""
+        if self.lexer.peek_kind() == KIND_INTEGER:
+            return self.parseAssignment(self.variable('M'))
         num = self.lexer.get_token()
-        if num.is_int():
-            num = num.to_int()
-            token = self.lexer.get_token()
-            if token == '=':
-                val = self.parseExpression()
-                self.variable_dict.set_m_variable(num, val)
-            else:
-                self.lexer.put_token(token)
-                # Report M variable values (do nothing)
-        else:
-            raise ParserError('Unexpected statement: M %s' % num, num)
+        raise ParserError('Unexpected statement: M %s' % num, num)
 
     def parseI(self):
         """Parse an I expression - typically an assignment."""
-        num = self.lexer.get_token()
-        if num.is_int():
-            num = num.to_int()
-            token = self.lexer.get_token()
-            if token == '=':
-                val = self.parseExpression()
-                self.variable_dict.set_i_variable(num, val)
-            else:
-                self.lexer.put_token(token)
-                # Report I variable values (do nothing)
-        elif num == '(':
+        kind = self.lexer.peek_kind()
+        if kind == KIND_INTEGER:
+            return self.parseAssignment(self.variable('I'))
+        elif kind == KIND_OPEN:
+            self.lexer.get_token()
             num = self.parseExpression()
-            self.lexer.get_token(')')
-            token = self.lexer.get_token()
-            if token == '=':
-                val = self.parseExpression()
-                self.variable_dict.set_i_variable(num, val)
-            else:
-                self.lexer.put_token(token)
-                # Report I variable values (do nothing)
-        else:
-            raise ParserError('Unexpected statement: I %s' % num, num)
+            self.expect_token(')')
+            return self.parseAssignment(IndirectVariable('I', num))
+        num = self.lexer.get_token()
+        raise ParserError('Unexpected statement: I %s' % num, num)
 
     def parseP(self):
         """Parse a P expression - typically an assignment."""
-        num = self.lexer.get_token()
-        if num.is_int():
-            num = num.to_int()
-            token = self.lexer.get_token()
-            if token == '=':
-                val = self.parseExpression()
-                self.variable_dict.set_p_variable(num, val)
-            else:
-                self.lexer.put_token(token)
-                # Report P variable values (do nothing)
-        elif num == '(':
+        kind = self.lexer.peek_kind()
+        if kind == KIND_INTEGER:
+            return self.parseAssignment(self.variable('P'))
+        elif kind == KIND_OPEN:
+            self.lexer.get_token()
             num = self.parseExpression()
-            self.lexer.get_token(')')
-            token = self.lexer.get_token()
-            if token == '=':
-                val = self.parseExpression()
-                self.variable_dict.set_p_variable(num, val)
-            else:
-                self.lexer.put_token(token)
-                # Report P variable values (do nothing)
-        else:
-            self.lexer.put_token(num)
-            # Do nothing
+            self.expect_token(')')
+            return self.parseAssignment(IndirectVariable('P', num))
+        # Do nothing
+        return None
 
     def parseQ(self):
         """Parse a Q expression - typically an assignment."""
-        num = self.lexer.get_token()
-        if num.is_int():
-            num = num.to_int()
-            token = self.lexer.get_token()
-            if token == '=':
-                val = self.parseExpression()
-                self.variable_dict.set_q_variable(num, val)
-            else:
-                self.lexer.put_token(token)
-                # Report Q variable values (do nothing)
-        elif num == '(':
+        kind = self.lexer.peek_kind()
+        if kind == KIND_INTEGER:
+            return self.parseAssignment(self.variable('Q'))
+        elif kind == KIND_OPEN:
+            self.lexer.get_token()
             num = self.parseExpression()
-            self.lexer.get_token(')')
-            token = self.lexer.get_token()
-            if token == '=':
-                val = self.parseExpression()
-                self.variable_dict.set_q_variable(num, val)
-            else:
-                self.lexer.put_token(token)
-                # Report Q variable values (do nothing)
-        else:
-            self.lexer.put_token(num)
-            # Do nothing
+            self.expect_token(')')
+            return self.parseAssignment(IndirectVariable('Q', num))
+        # Do nothing
+        return None
 
     def parseCondition(self):
-        """Parse a condition, return the result of the condition."""
-        has_parenthesis = True
-        token = self.lexer.get_token()
-        if token != '(':
-            self.lexer.put_token(token)
-            has_parenthesis = False
+        """Parse a condition, return the tree of the condition."""
+        has_parenthesis = self.lexer.peek_kind() == KIND_OPEN
+        if has_parenthesis:
+            self.lexer.get_token()
 
         value1 = self.parseExpression()
-        token = self.lexer.get_token()
-        comparator = token
+        comparator = self.lexer.get_token()
         value2 = self.parseExpression()
 
-        if comparator == '=':
-            result = value1 == value2
-        elif comparator == '!=':
-            result = value1 != value2
-        elif comparator == '>':
-            result = value1 > value2
-        elif comparator == '!>':
-            result = value1 <= value2
-        elif comparator == '<':
-            result = value1 < value2
-        elif comparator == '!<':
-            result = value1 >= value2
-        else:
+        if comparator is None or comparator.kind not in COMPARATOR_KINDS:
             raise ParserError('Expected comparator, got: %s' % comparator, comparator)
+        result = Comparison(comparator.text, value1, value2)
 
         # Take ) or AND or OR
-        token = self.lexer.get_token()
-        if token == 'AND' or token == 'OR':
-            self.lexer.put_token(token)
+        kind = self.lexer.peek_kind()
+        if kind == KIND_AND or kind == KIND_OR:
             result = self.parseConditionalOR(result)
             if has_parenthesis:
-                self.lexer.get_token(')')
-        elif token == ')':
-            if not has_parenthesis:
-                self.lexer.put_token(token)
-        elif token != ')':
+                self.expect_token(')')
+        elif kind == KIND_CLOSE:
+            if has_parenthesis:
+                self.lexer.get_token()
+        else:
             raise ParserError('Expected ) or AND/OR, got: %s' % comparator, comparator)
 
         return result
 
     def parseConditionalOR(self, current_value):
-        """Parse a conditional OR token, return the result of the condition."""
+        """Parse a conditional OR token, return the tree of the condition."""
         result = self.parseConditionalAND(current_value)
-        token = self.lexer.get_token()
-        if token == 'OR':
+        kind = self.lexer.peek_kind()
+        if kind == KIND_OR:
+            self.lexer.get_token()
             condition_result = self.parseCondition()
-            result = self.parseConditionalOR(condition_result) or current_value
-        elif token == 'AND':
-            self.lexer.put_token(token)
+            result = Or(self.parseConditionalOR(condition_result), current_value)
+        elif kind == KIND_AND:
             result = self.parseConditionalOR(result)
-        else:
-            self.lexer.put_token(token)
 
         return result
 
     def parseConditionalAND(self, current_value):
-        """Parse a conditional AND token, return the result of the condition."""
-        token = self.lexer.get_token()
-        if token == 'AND':
-            result = self.parseCondition() and current_value
+        """Parse a conditional AND token, return the tree of the condition."""
+        if self.lexer.peek_kind() == KIND_AND:
+            self.lexer.get_token()
+            result = And(self.parseCondition(), current_value)
         else:
-            self.lexer.put_token(token)
             result = current_value
         return result
 
     def parseIf(self):
-        """Parse an IF token, skipping to after the else if necessary."""
+        """Parse an IF block, with its optional ELSE block, up to the ENDIF."""
+        else_index, end_index = self.lexer.block(self.lexer.cur_token - 1)
+
         condition = self.parseCondition()
 
         if_condition = self.parseConditionalOR(condition)
 
-        # Condition could be numpy array, check and throw if not all True or all False
-        if np.all(if_condition):
-            if_condition = True
-        elif not np.any(if_condition):
-            if_condition = False
-        else:
-            raise Exception('If conditions is an array with not all the same value')
-
-        self.if_level += 1
-        if not if_condition:
-            this_if_level = self.if_level
-            token = self.lexer.get_token()
-            while (token != 'ELSE' and token not in ('ENDIF', 'ENDI')) or this_if_level != self.if_level:
-                if token in ('ENDIF', 'ENDI'):
-                    self.if_level -= 1
-                token = self.lexer.get_token()
-                if token == 'IF':
-                    self.if_level += 1
-
-            if token in ('ENDIF', 'ENDI'):
-                self.parseEndIf(token)
+        then_block = self.parseBlock(end_index if else_index is None else else_index)
+        else_block = ()
+        if else_index is not None:
+            self.expect_token('ELSE')
+            else_block = self.parseBlock(end_index)
+        # An IF left open at the end of the program runs to the end of the program
+        if end_index is not None:
+            self.lexer.get_token()
 
-    def parseElse(self, token):
-        """Parse an ELSE token, skipping to ENDIF if necessary."""
-        if self.if_level > 0:
-            this_if_level = self.if_level
-            while token not in ('ENDIF', 'ENDI') or this_if_level != self.if_level:
-                if token in ('ENDIF', 'ENDI'):
-                    self.if_level -= 1
-
-                token = self.lexer.get_token()
-
-                if token == 'IF':
-                    self.if_level += 1
-        else:
-            raise ParserError('Unexpected ELSE', token)
-
-    def parseEndIf(self, t):
-        """Parse an ENDIF token, closing off the current IF level."""
-        if self.if_level > 0:
-            self.if_level -= 1
-        else:
-            raise ParserError('Unexpected ENDIF/ENDI', t)
+        return If(if_condition, then_block, else_block)
 
     def parseWhile(self, token):
-        """Parse a WHILE token, skipping to the ENDWHILE the condition is false."""
-        self.while_level += 1
-
-        # Get all tokens up to the ENDWHILE
-        while_tokens = []
-        this_while_level = self.while_level
-        while_tokens.append(token)
-
-        while (token not in ('ENDWHILE', 'ENDW')) or this_while_level != self.while_level:
-            if token in ('ENDWHILE', 'ENDW'):
-                self.while_level -= 1
-
-            token = self.lexer.get_token()
-            while_tokens.append(token)
-
-            if token == 'WHILE':
-                self.while_level += 1
-
-        # Put the tokens back on
-        self.lexer.put_tokens(while_tokens)
-
-        # Get the WHILE
-        token = self.lexer.get_token()
+        """Parse a WHILE loop up to the ENDWHILE."""
+        else_index, end_index = self.lexer.block(self.lexer.cur_token - 1)
+        if end_index is None:
+            raise ParserError('Expected ENDWHILE/ENDW, got end of program', token)
 
         condition = self.parseCondition()
 
         condition = self.parseConditionalOR(condition)
 
-        # Condition could be numpy array, check and throw if not all True or all False
-        if np.all(condition):
-            condition = True
-        elif not np.any(condition):
-            condition = False
-        else:
-            raise Exception('While conditions is an array with not all the same value')
+        body = self.parseBlock(end_index)
+        self.lexer.get_token()
 
-        if condition:
-            self.while_dict[this_while_level] = while_tokens
-        else:
-            while (token not in ('ENDWHILE', 'ENDW')) or this_while_level != self.while_level:
-                if token in ('ENDWHILE', 'ENDW'):
-                    self.while_level -= 1
-
-                token = self.lexer.get_token()
-                while_tokens.append(token)
-
-                if token == 'WHILE':
-                    self.while_level += 1
-            self.while_level -= 1
-
-    def parseEndWhile(self, t):
-        """Parse an ENDWHILE statement, placing the tokens within the while back on to the list to be executed."""
-        if self.while_level > 0:
-
-            while_tokens = self.while_dict[self.while_level]
-
-            # Put the tokens back on
-            self.lexer.put_tokens(while_tokens)
-
-            self.while_level -= 1
-        else:
-            raise ParserError('Unexpected ENDWHILE/ENDW', t)
+        return While(condition, body)
 
     def parseReturn(self, t):
         """Parse a RETURN statement, which can just be ignored."""
-        pass
+        return None
 
     def parseExpression(self):
-        """Return the result of the expression."""
+        """Return the tree of the expression."""
         # Currently supports syntax of the form:
         #    <expression> ::= <e1> { <sumop> <e1> }
         #    <e1> ::= <e2> { <multop> <e2> }
@@ -448,215 +515,67 @@ class PMACParser(object):
         #    <mathop> ::= 'SIN' | 'COS' | 'TAB' | 'ASIN' | 'ACOS' | 'ATAN' | 'ATAN2'
         #                  | 'SQRT' | 'ABS' | 'EXT' | 'IN' | 'LN'
         result = self.parseE1()
-        going = True
-        while going:
-            token = self.lexer.get_token()
-            if token == '+':
-                result = result + self.parseE1()
-            elif token == '-':
-                result = result - self.parseE1()
-            elif token == '|':
-                result = np.bitwise_or(np.array(result).astype(int), np.array(self.parseE1()).astype(int))
-            elif token == '^':
-                result = np.bitwise_xor(np.array(result).astype(int), np.array(self.parseE1()).astype(int))
-            else:
-                self.lexer.put_token(token)
-                going = False
+        while self.lexer.peek_kind() in SUM_OPERATOR_KINDS:
+            operator = self.lexer.get_token().text
+            result = BinaryOperation(operator, result, self.parseE1())
         return result
 
     def parseE1(self):
-        """Return the result of a sub-expression containing multiplicative operands."""
+        """Return the tree of a sub-expression containing multiplicative operands."""
         result = self.parseE2()
-        going = True
-        while going:
-            token = self.lexer.get_token()
-            if token == '*':
-                result = result * self.parseE2()
-            elif token == '/':
-                result = result / self.parseE2()
-            elif token == '%':
-                result = result % self.parseE2()
-            elif token == '&':
-                result = np.bitwise_and(np.array(result).astype(int), np.array(self.parseE2()).astype(int))
-            else:
-                self.lexer.put_token(token)
-                going = False
+        while self.lexer.peek_kind() in PRODUCT_OPERATOR_KINDS:
+            operator = self.lexer.get_token().text
+            result = BinaryOperation(operator, result, self.parseE2())
         return result
 
     def parseE2(self):
-        """Return the result of a sub-expression containing monadic operands."""
-        monop = self.lexer.get_token()
-        if monop not in ['+', '-']:
-            self.lexer.put_token(monop)
-            monop = '+'
+        """Return the tree of a sub-expression containing monadic operands."""
+        monop = self.lexer.peek_kind()
+        if monop in SIGN_KINDS:
+            self.lexer.get_token()
         result = self.parseE3()
-        if monop == '-':
-            result = -result
+        if monop == KIND_MINUS:
+            result = Negate(result)
         return result
 
     def parseE3(self):
-        """Return the result of a sub-expression containing a value.
+        """Return the tree of a sub-expression containing a value.
 
         This could be an I,P,Q or M variable, or a constant or a
         parenthesised expression, or a mathematical operation.
         """
-        token = self.lexer.get_token()
-        if token == '(':
+        kind = self.lexer.peek_kind()
+        if kind == KIND_OPEN:
+            self.lexer.get_token()
             result = self.parseExpression()
-            self.lexer.get_token(')')
-        elif token == 'Q':
-            token = self.lexer.get_token()
-            if token == '(':
-                value = self.parseExpression()
-                self.lexer.get_token(')')
-            else:
-                value = token
-            result = self.variable_dict.get_q_variable(value)
-        elif token == 'P':
-            token = self.lexer.get_token()
-            if token == '(':
-                value = self.parseExpression()
-                self.lexer.get_token(')')
-            else:
-                value = token
-            result = self.variable_dict.get_p_variable(value)
-        elif token == 'I':
-            token = self.lexer.get_token()
-            if token == '(':
-                value = self.parseExpression()
-                self.lexer.get_token(')')
-            else:
-                value = token
-            result = self.variable_dict.get_i_variable(value)
-        elif token == 'M':
-            token = self.lexer.get_token()
-            if token == '(':
-                value = self.parseExpression()
-                self.lexer.get_token(')')
-            else:
-                value = token
-            result = self.variable_dict.get_m_variable(value)
-        elif token == 'SIN':
-            token = self.lexer.get_token()
-            if token == '(':
-                value = self.parseExpression()
-                self.lexer.get_token(')')
-            else:
-                value = token
-            I15 = self.variable_dict.get_i_variable(15)
-            if I15 == 0:
-                value = np.radians(value)
-            result = np.sin(value)
-        elif token == 'COS':
-            token = self.lexer.get_token()
-            if token == '(':
-                value = self.parseExpression()
-                self.lexer.get_token(')')
-            else:
-                value = token
-            I15 = self.variable_dict.get_i_variable(15)
-            if I15 == 0:
-                value = np.radians(value)
-            result = np.cos(value)
-        elif token == 'TAN':
-            token = self.lexer.get_token()
-            if token == '(':
-                value = self.parseExpression()
-                self.lexer.get_token(')')
-            else:
-                value = token
-            I15 = self.variable_dict.get_i_variable(15)
-            if I15 == 0:
-                value = np.radians(value)
-            result = np.tan(value)
-        elif token == 'ASIN':
-            token = self.lexer.get_token()
-            if token == '(':
-                value = self.parseExpression()
-                self.lexer.get_token(')')
-            else:
-                value = token
-            result = np.arcsin(value)
-            I15 = self.variable_dict.get_i_variable(15)
-            if I15 == 0:
-                result = np.degrees(result)
-        elif token == 'ACOS':
-            token = self.lexer.get_token()
-            if token == '(':
-                value = self.parseExpression()
-                self.lexer.get_token(')')
+            self.expect_token(')')
+        elif kind in VARIABLE_KINDS:
+            var_type = self.lexer.get_token().text
+            kind = self.lexer.peek_kind()
+            if kind == KIND_OPEN:
+                self.lexer.get_token()
+                result = IndirectVariable(var_type, self.parseExpression())
+                self.expect_token(')')
+            elif kind == KIND_INTEGER:
+                result = self.variable(var_type)
             else:
-                value = token
-            result = np.arccos(value)
-            I15 = self.variable_dict.get_i_variable(15)
-            if I15 == 0:
-                result = np.degrees(result)
-        elif token == 'ATAN':
-            token = self.lexer.get_token()
-            if token == '(':
-                value = self.parseExpression()
-                self.lexer.get_token(')')
-            else:
-                value = token
-            result = np.arctan(value)
-            I15 = self.variable_dict.get_i_variable(15)
-            if I15 == 0:
-                result = np.degrees(result)
-        elif token == 'ATAN2':
-            token = self.lexer.get_token()
-            if token == '(':
-                value = self.parseExpression()
-                self.lexer.get_token(')')
-            else:
-                value = token
-
-            # PMAC uses the value in Q0 as the cosine argument
-            Q0 = self.variable_dict.get_q_variable(0)
-
-            result = np.arctan2(value, Q0)
-            I15 = self.variable_dict.get_i_variable(15)
-            if I15 == 0:
-                result = np.degrees(result)
-        elif token == 'SQRT':
-            token = self.lexer.get_token()
-            if token == '(':
-                value = self.parseExpression()
-                self.lexer.get_token(')')
-            else:
-                value = token
-            result = np.sqrt(value)
-        elif token == 'ABS':
-            token = self.lexer.get_token()
-            if token == '(':
-                value = self.parseExpression()
-                self.lexer.get_token(')')
-            else:
-                value = token
-            result = np.abs(value)
-        elif token == 'EXP':
-            token = self.lexer.get_token()
-            if token == '(':
-                value = self.parseExpression()
-                self.lexer.get_token(')')
-            else:
-                value = token
-            result = np.exp(value)
-        elif token == 'INT':
-            token = self.lexer.get_token()
-            if token == '(':
-                value = self.parseExpression()
-                self.lexer.get_token(')')
-            else:
-                value = token
-            result = np.floor(value)
-        elif token == 'LN':
-            token = self.lexer.get_token()
-            if token == '(':
+                token = self.lexer.get_token()
+                raise ParserError('Expected variable number, got: %s' % token, token)
+        elif kind in MATH_FUNCTION_KINDS:
+            function = self.lexer.get_token().text
+            if self.lexer.peek_kind() == KIND_OPEN:
+                self.lexer.get_token()
                 value = self.parseExpression()
-                self.lexer.get_token(')')
+                self.expect_token(')')
             else:
-                value = token
-            result = np.log(value)
+                value = self.parseConstant(self.lexer.get_token())
+            result = MathFunction(function, value)
         else:
-            result = token.to_float()
+            result = self.parseConstant(self.lexer.get_token())
         return result
+
+    def parseConstant(self, token):
+        """Return the tree of a numeric constant."""
+        if token is None or token.kind not in NUMBER_KINDS:
+            raise ParserError('Float expected, got: %s' % token, token)
+        return Constant(token.to_float())
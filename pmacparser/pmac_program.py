@@ -0,0 +1,202 @@
+"""PMAC Program
+
+A parsed PMAC program, which any number of threads can run at once
+"""
+
+import os
+
+import numpy as np
+
+from pmacparser.pmac_ast import BRANCH_UNIFORM, BRANCH_AUTO, execute_block
+from pmacparser.pmac_codegen import CompiledProgram, is_scalar_input
+from pmacparser.pmac_variables import split_address, thread_context
+
+# Number of elements of the input arrays run at once by a chunked run
+CHUNK_SIZE = 65536
+
+
+def is_number_input(variable_dict):
+    """Return true if the values of all of the variables in the input dictionary are single numbers."""
+    for addr, value in variable_dict.items():
+        if not isinstance(value, (int, float, np.number)) and split_address(addr) is not None:
+            return False
+    return True
+
+
+def stack_inputs(variable_dicts):
+    """Return an input dictionary holding an array of the values of each variable in the input dictionaries.
+
+    A variable missing from an input dictionary is zero for that input, as
+    it would be if the input was run on its own.
+    """
+    addresses = set()
+    for variable_dict in variable_dicts:
+        addresses.update(addr for addr in variable_dict if split_address(addr) is not None)
+    return dict((addr, np.array([variable_dict.get(addr, 0) for variable_dict in variable_dicts], dtype=float))
+                for addr in addresses)
+
+
+class Program(object):
+
+    """A parsed PMAC program, made by PMACParser.
+
+    The program holds the syntax tree of its top level statements, or the
+    syntax error that stopped it being parsed, and the code it is compiled
+    to. None of these change once they are made, so a program can be shared
+    by any number of threads. The variables of each run are held in an
+    execution context, by default that of the thread running the program.
+    """
+
+    def __init__(self, statements, error=None):
+        self.statements = statements
+        self.error = error
+        # The programs compiled from the statements, keyed by scalar
+        self.compiled_programs = {}
+
+    def compile(self, scalar=False):
+        """Return the program compiled to a native python function.
+
+        If scalar is true the function uses the math module and only works
+        for scalar inputs. The function is compiled the first time it is
+        asked for, and shared from then on.
+        """
+        if self.error is not None:
+            raise self.error
+        compiled = self.compiled_programs.get(scalar)
+        if compiled is None:
+            compiled = self.compiled_programs[scalar] = CompiledProgram(self.statements, scalar=scalar)
+        return compiled
+
+    def run(self, variable_dict, branches=BRANCH_UNIFORM, context=None):
+        """Run the program on a copy of the input dictionary, returning the result.
+
+        The program runs in the execution context given, or the context of
+        the calling thread. The branches are as for PMACParser.parse.
+        """
+        if self.error is not None:
+            raise self.error
+        if context is None:
+            context = thread_context()
+        if is_scalar_input(variable_dict):
+            try:
+                return self.compile(scalar=True)(variable_dict, context)
+            except (ArithmeticError, ValueError):
+                # Numpy gives an infinity or a NaN for these instead
+                pass
+        variables = context.get_variables()
+        variables.populate_with_dict(variable_dict)
+        variables.branches = branches
+        execute_block(self.statements, variables)
+        return variables.to_dict()
+
+    def run_many(self, variable_dicts, branches=BRANCH_AUTO, columnar=False, context=None):
+        """Run the program on each of the input dictionaries, returning a list of the results.
+
+        The inputs whose variables are all single numbers are stacked into an
+        array of the values of each variable, and the program is run once on
+        the arrays, with each element taking its own branches. The results are
+        then split back into a dictionary for each input. A variable assigned
+        for any of the inputs is in the results for all of them, holding the
+        value it had before for the inputs that did not assign it. Any other
+        input is run on its own, as all of them are if the program cannot run
+        on arrays, such as when it addresses a variable indirectly by one.
+
+        If columnar is true the result is one dictionary of arrays holding the
+        values of each variable for all of the inputs, in the same order,
+        which must then all be numbers.
+        """
+        if self.error is not None:
+            raise self.error
+        if context is None:
+            context = thread_context()
+        variable_dicts = list(variable_dicts)
+        stacked_rows = [row for row, variable_dict in enumerate(variable_dicts) if is_number_input(variable_dict)]
+        if columnar and len(stacked_rows) < len(variable_dicts):
+            raise ValueError('Columnar results need inputs of single numbers')
+
+        results = [None] * len(variable_dicts)
+        count = len(stacked_rows)
+        stacked = stack_inputs([variable_dicts[row] for row in stacked_rows])
+        try:
+            output_dict = self.run(stacked, branches, context) if count else {}
+        except (TypeError, ValueError, IndexError):
+            # An array was used where the program needs a single number
+            output_dict = None
+        if output_dict is not None:
+            # The values that are not the stacked inputs were assigned by the program
+            assigned = dict((addr, value) for addr, value in output_dict.items() if value is not stacked.get(addr))
+            if columnar:
+                stacked.update((addr, np.array(np.broadcast_to(value, (count,)), dtype=float))
+                               for addr, value in assigned.items())
+                return stacked
+            columns = dict((addr, value.tolist() if np.ndim(value) else [float(value)] * count)
+                           for addr, value in assigned.items())
+            for index, row in enumerate(stacked_rows):
+                result = results[row] = variable_dicts[row].copy()
+                for addr, column in columns.items():
+                    result[addr] = column[index]
+
+        for row, variable_dict in enumerate(variable_dicts):
+            if results[row] is None:
+                results[row] = self.run(variable_dict, branches, context)
+        if columnar:
+            return dict((addr, np.array([result.get(addr, 0) for result in results], dtype=float))
+                        for addr in stack_inputs(results))
+        return results
+
+    def run_chunked(self, variable_dict, outputs=None, directory=None, chunk_size=CHUNK_SIZE, branches=BRANCH_AUTO,
+                    context=None):
+        """Run the program on input arrays chunk by chunk, returning a dictionary of the output arrays.
+
+        The input arrays can be any arrays that can be sliced, such as
+        numpy memory maps, and must all be the same length. The program is run
+        on chunk_size elements of them at a time, so the memory used is set by
+        the chunk size rather than the length of the arrays. The results of
+        each chunk are written into the arrays given in outputs for any of the
+        variables, and into new arrays for the other variables the program
+        assigns. The new arrays are .npy files memory mapped in the directory
+        if one is given, or held in memory. As for run_many, a variable
+        assigned for any element holds the value it had before for the other
+        elements.
+        """
+        if self.error is not None:
+            raise self.error
+        if context is None:
+            context = thread_context()
+        arrays = dict((addr, value) for addr, value in variable_dict.items()
+                      if split_address(addr) is not None and np.ndim(value))
+        lengths = set(len(value) for value in arrays.values())
+        if len(lengths) != 1:
+            raise ValueError('Chunked runs need input arrays of one length')
+        length = lengths.pop()
+        outputs = {} if outputs is None else dict(outputs)
+        if any(len(output) != length for output in outputs.values()):
+            raise ValueError('Output arrays must be the length of the input arrays')
+
+        chunk_dict = variable_dict.copy()
+        for start in range(0, length, chunk_size):
+            stop = min(start + chunk_size, length)
+            for addr, value in arrays.items():
+                chunk_dict[addr] = np.asarray(value[start:stop], dtype=float)
+            output_dict = self.run(chunk_dict, branches, context)
+            for addr, value in output_dict.items():
+                if addr not in outputs and value is not chunk_dict.get(addr):
+                    shape = (length,) + np.shape(value)[1:]
+                    if directory is None:
+                        output = np.empty(shape)
+                    else:
+                        output = np.lib.format.open_memmap(os.path.join(directory, addr + '.npy'), mode='w+',
+                                                           dtype=float, shape=shape)
+                    # The elements of the chunks before hold the value the variable had before
+                    before = arrays.get(addr)
+                    for filled in range(0, start, chunk_size):
+                        output[filled:filled + chunk_size] = (variable_dict.get(addr, 0) if before is None
+                                                              else before[filled:filled + chunk_size])
+                    outputs[addr] = output
+            for addr, output in outputs.items():
+                output[start:stop] = output_dict.get(addr, 0)
+
+        for output in outputs.values():
+            if isinstance(output, np.memmap):
+                output.flush()
+        return outputs
@@ -0,0 +1,281 @@
+"""PMAC Variables
+
+Store of the I, M, P and Q variables used while running a PMAC program
+"""
+
+import threading
+
+import numpy as np
+
+from pmacparser.pmac_ast import BRANCH_UNIFORM
+
+VARIABLE_TYPES = ('P', 'Q', 'I', 'M')
+
+# Number of variables of each type, I0..I8191, M0..M8191, P0..P8191 and Q0..Q8191 per coordinate system
+VARIABLE_COUNT = 8192
+
+# Value of a variable that has not been set
+ZERO = np.float64(0)
+
+
+def to_float(value):
+    """Return the value as a numpy float, or a numpy array of floats, as the variables are held."""
+    if type(value) is np.float64:
+        return value
+    elif isinstance(value, np.ndarray) and value.ndim:
+        return value if value.dtype == np.float64 else value.astype(float)
+    return np.float64(value)
+
+
+class VariableBank(list):
+
+    """The values of one type of variable, indexed by variable number.
+
+    Variables that have not been set hold zero, and the numbers of those
+    that have been set are kept in defined so they can be exported. The
+    number of variables holding arrays is kept in arrays.
+    """
+
+    __slots__ = ('defined', 'zero', 'arrays')
+
+    def __init__(self, zero=ZERO):
+        super(VariableBank, self).__init__([zero] * VARIABLE_COUNT)
+        self.defined = set()
+        self.zero = zero
+        self.arrays = 0
+
+    def set_value(self, var_num, value):
+        """Set a variable to a value that has already been converted."""
+        self.arrays += isinstance(value, np.ndarray) - isinstance(self[var_num], np.ndarray)
+        self[var_num] = value
+        self.defined.add(var_num)
+
+    def clear_defined(self):
+        """Set all of the variables back to zero."""
+        zero = self.zero
+        for var_num in self.defined:
+            self[var_num] = zero
+        self.defined.clear()
+        self.arrays = 0
+
+
+# Addresses that have been split before, as the same ones are imported on every run
+_addresses = {}
+
+
+def split_address(addr):
+    """Split a variable address such as 'P4801' into its type and number.
+
+    Return None if the address is not that of a variable, and raise a
+    ValueError if the number is beyond the last variable of its type.
+    """
+    address = _addresses.get(addr)
+    if address is None:
+        var_type, var_num = addr[:1], addr[1:]
+        if var_type in VARIABLE_TYPES and var_num.isdigit():
+            if int(var_num) >= VARIABLE_COUNT:
+                raise ValueError('%s variable number out of range: %s' % (var_type, var_num))
+            address = _addresses[addr] = (var_type, int(var_num))
+    return address
+
+
+# Addresses of the variables that have been exported before
+_address_names = {}
+
+
+def join_address(var_type, var_num):
+    """Return the address of a variable, such as 'P4801', from its type and number."""
+    addr = _address_names.get((var_type, var_num))
+    if addr is None:
+        addr = _address_names[var_type, var_num] = '%s%d' % (var_type, var_num)
+    return addr
+
+
+class Variables(object):
+
+    """Represents a PMAC Variable (I, M, P, Q).
+
+    The variables of each type are held in preallocated banks indexed by
+    variable number, with a bank of Q variables for each coordinate system.
+    Dictionaries keyed by addresses such as 'P4801' are only used to import
+    and export the variables. Values are converted to floats as they are
+    imported or set, so reading a variable needs no conversion.
+
+    Assignments made while a mask is set only change the elements of an
+    array variable where the mask is true.
+
+    The values are numpy floats by default. Passing float as the convert
+    function holds plain python floats instead, for the scalar backend.
+    """
+
+    def __init__(self, coordinate_system=1, convert=to_float):
+        self.convert = convert
+        self.zero = convert(0)
+        self.i_variables = VariableBank(self.zero)
+        self.m_variables = VariableBank(self.zero)
+        self.p_variables = VariableBank(self.zero)
+        self.q_variables = {}
+        self.banks = {}
+        self.coordinate_system = None
+        self.select_coordinate_system(coordinate_system)
+        # The input dictionary and the variables as they were imported from it
+        self.input_dict = {}
+        self.initial = {}
+        self.mask = None
+        self.branches = BRANCH_UNIFORM
+
+    def select_coordinate_system(self, coordinate_system):
+        """Select the coordinate system whose Q variables are used."""
+        if coordinate_system not in self.q_variables:
+            self.q_variables[coordinate_system] = VariableBank(self.zero)
+        self.coordinate_system = coordinate_system
+        self.banks = {'P': self.p_variables, 'Q': self.q_variables[coordinate_system],
+                      'I': self.i_variables, 'M': self.m_variables}
+
+    def get_i_variable(self, var_num):
+        """Return the value of the specified I variable."""
+        return self.get_var('I', var_num)
+
+    def get_p_variable(self, var_num):
+        """Return the value of the specified P variable."""
+        return self.get_var('P', var_num)
+
+    def get_q_variable(self, var_num):
+        """Return the value of the specified Q variable."""
+        return self.get_var('Q', var_num)
+
+    def get_m_variable(self, var_num):
+        """Return the value of the specified M variable."""
+        return self.get_var('M', var_num)
+
+    def set_i_variable(self, var_num, value):
+        """Set the value of the specified I variable."""
+        self.set_var('I', var_num, value)
+
+    def set_p_variable(self, var_num, value):
+        """Set the value of the specified P variable."""
+        self.set_var('P', var_num, value)
+
+    def set_q_variable(self, var_num, value):
+        """Set the value of the specified Q variable."""
+        self.set_var('Q', var_num, value)
+
+    def set_m_variable(self, var_num, value):
+        """Set the value of the specified M variable."""
+        self.set_var('M', var_num, value)
+
+    def get_var(self, var_type, var_num):
+        """Return the value of the specified variable type and number."""
+        return self.banks[var_type][var_num]
+
+    def set_var(self, var_type, var_num, value):
+        """Set the value of the variable type and number with the value specified."""
+        if self.mask is not None:
+            value = np.where(self.mask, value, self.get_var(var_type, var_num))
+        self.banks[var_type].set_value(var_num, self.convert(value))
+
+    def clear(self):
+        """Set all of the variables back to zero."""
+        for bank in [self.i_variables, self.m_variables, self.p_variables] + list(self.q_variables.values()):
+            bank.clear_defined()
+        self.input_dict = {}
+        self.initial = {}
+        self.mask = None
+
+    def populate_with_dict(self, dictionary):
+        """Copy the input dictionary into the variables.
+
+        Input arrays are copied, so that the arrays assigned by the program
+        never share the memory of the caller's arrays.
+        """
+        self.clear()
+        self.input_dict = dictionary
+        banks, initial, convert = self.banks, self.initial, self.convert
+        for addr, value in dictionary.items():
+            address = _addresses.get(addr) or split_address(addr)
+            if address is not None:
+                var_type, var_num = address
+                if isinstance(value, np.ndarray) and value.ndim:
+                    value = np.array(value, dtype=float)
+                value = initial[address] = convert(value)
+                banks[var_type].set_value(var_num, value)
+
+    def array_count(self):
+        """Return the number of variables holding arrays, which are counted as they are set."""
+        banks = self.banks
+        return banks['P'].arrays + banks['Q'].arrays + banks['I'].arrays + banks['M'].arrays
+
+    def partition(self, mask):
+        """Return new variables holding just the elements of the array variables selected by the mask."""
+        partition = Variables(self.coordinate_system)
+        partition.branches = self.branches
+        for var_type, bank in self.banks.items():
+            partition_bank = partition.banks[var_type]
+            for var_num in bank.defined:
+                value = bank[var_num]
+                if isinstance(value, np.ndarray) and value.shape == mask.shape:
+                    value = value[mask]
+                partition_bank.set_value(var_num, value)
+                partition.initial[var_type, var_num] = value
+        return partition
+
+    def merge(self, partition, mask):
+        """Scatter the variables assigned in a partition back into the elements selected by the mask."""
+        for var_type, partition_bank in partition.banks.items():
+            bank = self.banks[var_type]
+            for var_num in partition_bank.defined:
+                value = partition_bank[var_num]
+                if value is not partition.initial.get((var_type, var_num)):
+                    result = np.array(np.broadcast_to(bank[var_num], mask.shape), dtype=float)
+                    result[mask] = value
+                    bank.set_value(var_num, result)
+
+    def to_dict(self):
+        """Return the variables as a copy of the input dictionary updated with the variables that have been set."""
+        result = self.input_dict.copy()
+        initial = self.initial
+        for var_type in VARIABLE_TYPES:
+            bank = self.banks[var_type]
+            for var_num in sorted(bank.defined):
+                value = bank[var_num]
+                if value is not initial.get((var_type, var_num)):
+                    result[join_address(var_type, var_num)] = value
+        return result
+
+
+class ExecutionContext(object):
+
+    """The state of running programs, the variables they run on.
+
+    A context runs one program at a time, but can run any number of programs
+    one after another, as the variables are cleared when the inputs of each
+    run are imported. The numpy variables, and the python float variables of
+    the scalar backend, are each made when they are first needed.
+    """
+
+    def __init__(self, coordinate_system=1):
+        self.coordinate_system = coordinate_system
+        self.variables = None
+        self.scalar_variables = None
+
+    def get_variables(self, scalar=False):
+        """Return the variables for running a program with numpy, or with the scalar backend if scalar is true."""
+        if scalar:
+            if self.scalar_variables is None:
+                self.scalar_variables = Variables(self.coordinate_system, convert=float)
+            return self.scalar_variables
+        if self.variables is None:
+            self.variables = Variables(self.coordinate_system)
+        return self.variables
+
+
+# The execution context of each thread
+_thread_contexts = threading.local()
+
+
+def thread_context():
+    """Return the execution context of the calling thread, which is made on its first run and then reused."""
+    context = getattr(_thread_contexts, 'context', None)
+    if context is None:
+        context = _thread_contexts.context = ExecutionContext()
+    return context
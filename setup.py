@@ -22,7 +22,10 @@ def get_version():
                            .format(VERSION_FILE))
 
 
-install_requires = ['numpy', 'pygments>=2']
+install_requires = ['numpy']
+
+# Pygments is only needed to highlight PMAC programs
+extras_require = {'highlight': ['pygments>=2']}
 
 setup(
     name=module_name,
@@ -43,6 +46,7 @@ setup(
     ],
     license='APACHE',
     install_requires=install_requires,
+    extras_require=extras_require,
     include_package_data=True,
     test_suite='nose.collector',
     tests_require=[
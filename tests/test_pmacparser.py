@@ -1,9 +1,26 @@
+import io
+import os
+import pickle
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
 import unittest
 from math import sqrt, exp, log
 
 import numpy as np
 
-from pmacparser.pmac_parser import PMACParser, ParserError
+from pmacparser.pmac_parser import PMACParser, ParserError, ProgramCache, program_key
+from pmacparser.pmac_lexer import PmacLexer, LineCache, SourceRegion, highlight_lexer
+from pmacparser.pmac_batch import compile_programs
+from pmacparser.pmac_codegen import CompiledProgram, load_compiled_program
+from pmacparser import pmac_cache
+from pmacparser.pmac_cache import PersistentProgramCache
+from pmacparser.pmac_backup import BackupFile, MappedBackupFile, FORWARD, INVERSE, PLC
+from pmacparser.pmac_variables import Variables, ExecutionContext
+from pmacparser.pmac_ast import Assignment, BinaryOperation, Comparison, Constant, If, Negate, Variable
+from pmacparser.pmac_ast import BRANCH_MASKED, BRANCH_PARTITIONED, BRANCH_AUTO
 
 
 class TestParser(unittest.TestCase):
@@ -1826,6 +1843,26 @@ class TestParser(unittest.TestCase):
         self.assertEqual(output_dict["Q1"], 2)
         self.assertEqual(output_dict["Q2"], 3)
 
+    def test_while_many_iterations(self):
+
+        input_dict = {"P1": 0}
+
+        lines = []
+        lines.append("WHILE(P1<10000)")
+        lines.append("P1=P1+1")
+        lines.append("IF(P1%1000=0)")
+        lines.append("P2=P2+1")
+        lines.append("ENDIF")
+        lines.append("ENDWHILE")
+
+        parser = PMACParser(lines)
+
+        output_dict = parser.parse(input_dict)
+
+        self.assertEqual(output_dict["P1"], 10000)
+        self.assertEqual(output_dict["P2"], 10)
+        self.assertEqual(parser.compile()(input_dict), output_dict)
+
     def test_parser_error(self):
 
         input_dict = {"Q1": 42}
@@ -1928,6 +1965,311 @@ class TestParser(unittest.TestCase):
 
         self.assertRaises(ParserError, parser.parse, input_dict)
 
+    def test_unterminated_while_error(self):
+
+        input_dict = {"Q1": 42}
+
+        lines = []
+        lines.append("WHILE(Q1<50)")
+        lines.append("Q1=Q1+1")
+
+        parser = PMACParser(lines)
+
+        self.assertRaises(ParserError, parser.parse, input_dict)
+
+    def test_error_in_branch_not_run(self):
+
+        lines = []
+        lines.append("IF(P1=1)")
+        lines.append("Q1=(")
+        lines.append("ENDIF")
+        lines.append("Q2=2")
+
+        parser = PMACParser(lines)
+
+        self.assertIsInstance(parser.error, ParserError)
+        self.assertEqual(parser.error.line, 3)
+        self.assertRaises(ParserError, parser.parse, {"P1": 0})
+        self.assertRaises(ParserError, parser.parse, {"P1": 1})
+
+    def test_syntax_tree(self):
+
+        lines = []
+        lines.append("Q1=P(4800+1)*2")
+        lines.append("IF(P1>0)")
+        lines.append("Q2=-P1")
+        lines.append("ENDIF")
+
+        parser = PMACParser(lines)
+
+        self.assertEqual(parser.statements, (
+            Assignment(Variable('Q', 1), BinaryOperation('*', Variable('P', 4801), Constant(2))),
+            If(Comparison('>', Variable('P', 1), Constant(0)),
+               (Assignment(Variable('Q', 2), Negate(Variable('P', 1))),)),
+        ))
+
+    def test_block_table(self):
+
+        lines = []
+        lines.append("IF(P1=1)")
+        lines.append("WHILE(P2<3)")
+        lines.append("P2=P2+1")
+        lines.append("ENDW")
+        lines.append("ELSE")
+        lines.append("IF(P1=2)")
+        lines.append("ENDIF")
+        lines.append("ENDIF")
+
+        parser = PMACParser(lines)
+
+        tokens = [str(token) for token in parser.lexer.lexed_tokens]
+        if_index, while_index, inner_if_index = [i for i, t in enumerate(tokens) if t in ("IF", "WHILE")]
+
+        self.assertEqual(parser.lexer.blocks[if_index], (tokens.index("ELSE"), len(tokens) - 1))
+        self.assertEqual(parser.lexer.blocks[while_index], (None, tokens.index("ENDW")))
+        self.assertEqual(parser.lexer.blocks[inner_if_index], (None, len(tokens) - 2))
+
+    def test_update_lines(self):
+
+        lines = []
+        lines.append("Q1=P1")
+        lines.append("IF(P1>1)")
+        lines.append("Q2=P1*2")
+        lines.append("ENDIF")
+        lines.append("Q3=Q1+1")
+
+        parser = PMACParser(lines)
+        last_statement = parser.statements[-1]
+
+        parser.update_lines(0, 1, ["Q1=P1", "+10"])
+
+        self.assertEqual(parser.lines, ["Q1=P1", "+10", "IF(P1>1)", "Q2=P1*2", "ENDIF", "Q3=Q1+1"])
+        self.assertEqual(parser.statements, PMACParser(parser.lines).statements)
+        self.assertIs(parser.statements[-1], last_statement)
+        self.assertEqual([token.line for token in parser.lexer.lexed_tokens][-1], 6)
+
+        output_dict = parser.parse({"P1": 2})
+
+        self.assertEqual(output_dict["Q1"], 12)
+        self.assertEqual(output_dict["Q2"], 4)
+        self.assertEqual(output_dict["Q3"], 13)
+
+    def test_program_cache(self):
+
+        program_cache = ProgramCache(size=1)
+        lines = ["Q1=P1*2 ; scale", "Q2=Q1+1"]
+
+        parser = PMACParser(lines, program_cache=program_cache)
+        cached_parser = PMACParser(["q1=p1*2", "q2=q1+1 ; offset"], program_cache=program_cache)
+
+        self.assertEqual((program_cache.hits, program_cache.misses), (1, 1))
+        self.assertIs(cached_parser.statements, parser.statements)
+        self.assertIs(cached_parser.compile(), parser.compile())
+        self.assertEqual(cached_parser.parse({"P1": 2})["Q2"], 5)
+
+        cached_parser.update_lines(1, 2, ["Q2=Q1+2"])
+
+        self.assertEqual(parser.parse({"P1": 2})["Q2"], 5)
+        self.assertEqual(cached_parser.parse({"P1": 2})["Q2"], 6)
+
+        PMACParser("Q1=P1*2\nQ2=Q1+1", program_cache=program_cache)
+
+        self.assertEqual((program_cache.hits, program_cache.misses), (1, 2))
+        self.assertEqual(len(program_cache.entries), 1)
+
+        # Lines and text are keyed apart, even where the text starts with an empty line
+        PMACParser(["Q1=1"], program_cache=program_cache)
+        PMACParser("\nQ1=1", program_cache=program_cache)
+
+        self.assertEqual((program_cache.hits, program_cache.misses), (1, 4))
+
+    def test_variable_range(self):
+
+        for lines, line in [(["P9000=1"], 1), (["Q1=1", "Q2=P8192"], 2), (["IF(M10000=1)", "ENDIF"], 1)]:
+            parser = PMACParser(lines)
+            self.assertIsInstance(parser.error, ParserError)
+            self.assertEqual(parser.error.line, line)
+
+        parser = PMACParser(["Q1=P8191", "P(P1)=2"])
+
+        self.assertIsNone(parser.error)
+        self.assertRaises(ValueError, parser.parse, {"P1": 1, "P8192": 1})
+        self.assertRaises(IndexError, parser.parse, {"P1": 8192})
+        self.assertRaises(IndexError, parser.compile(), {"P1": 8192})
+        self.assertEqual(parser.parse({"P1": 1, "P8191": 3, "X8192": 4})["Q1"], 3)
+
+    def test_program_key_chunks(self):
+
+        # Long enough to be hashed and lexed in several chunks
+        lines = ["\tQ%d=P%d*2 ; scale " % (number % 100, number % 1000) for number in range(8000)]
+        text = "\n".join(lines)
+        buffer = b"  " + text.encode() + b"\n"
+
+        key = program_key(text)[1]
+
+        self.assertEqual(program_key(text.upper().replace(" ; SCALE", ""))[1], key)
+        self.assertEqual(program_key(SourceRegion(buffer, 2, len(buffer) - 1))[1], key)
+        self.assertNotEqual(program_key(lines)[1], key)
+        parser = PMACParser(SourceRegion(buffer, 2, len(buffer)), program_cache=None)
+
+        self.assertEqual(parser.parse({"P999": 1})["Q99"], 2)
+
+    def test_program_cache_iterator(self):
+
+        program_cache = ProgramCache()
+        lines = ["Q1=P1*2", "Q2=Q1+1"]
+
+        iterated_parser = PMACParser(iter(lines), program_cache=program_cache)
+        parser = PMACParser(lines, program_cache=program_cache)
+
+        self.assertEqual(iterated_parser.parse({"P1": 2})["Q2"], 5)
+        self.assertEqual(iterated_parser.lines, lines)
+        self.assertEqual(parser.parse({"P1": 2})["Q2"], 5)
+
+    def test_threads(self):
+
+        lines = []
+        lines.append("Q1=0")
+        lines.append("P10=0")
+        lines.append("WHILE(P10<P1)")
+        lines.append("Q1=Q1+P2")
+        lines.append("P10=P10+1")
+        lines.append("ENDW")
+
+        parser = PMACParser(lines)
+        results = {}
+
+        def run(number):
+            results[number] = [parser.parse({"P1": number, "P2": 0.5})["Q1"] for _ in range(50)]
+
+        threads = [threading.Thread(target=run, args=(number,)) for number in range(1, 9)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        for number in range(1, 9):
+            self.assertEqual(results[number], [number * 0.5] * 50)
+
+    def test_execution_context(self):
+
+        program = PMACParser(["Q1=P1*2", "P2=Q1+1"]).program
+        context = ExecutionContext()
+
+        output_dict = program.run({"P1": np.array([1.0, 2.0])}, context=context)
+
+        np.testing.assert_array_equal(output_dict["P2"], [3, 5])
+        np.testing.assert_array_equal(context.get_variables().get_p_variable(2), [3, 5])
+        self.assertIsNone(context.scalar_variables)
+
+        self.assertEqual(program.run({"P1": 2}, context=context)["P2"], 5)
+        self.assertEqual(context.get_variables(scalar=True).get_p_variable(2), 5)
+
+    def test_update_blocks(self):
+
+        lines = []
+        lines.append("IF(P1=1)")
+        lines.append("Q1=1")
+        lines.append("ENDIF")
+        lines.append("WHILE(P2<3)")
+        lines.append("P2=P2+1")
+        lines.append("ENDW")
+
+        parser = PMACParser(lines)
+        parser.update_lines(2, 3, [])
+
+        self.assertEqual(parser.lexer.blocks, PMACParser(parser.lines).lexer.blocks)
+        self.assertNotIn("P2", parser.parse({"P1": 0}))
+
+        parser.update_lines(2, 2, ["ELSE", "Q1=2", "ENDI"])
+
+        self.assertEqual(parser.lexer.blocks, PMACParser(parser.lines).lexer.blocks)
+        self.assertEqual(parser.parse({"P1": 0})["Q1"], 2)
+        self.assertEqual(parser.parse({"P1": 0})["P2"], 3)
+
+        parser.update_lines(6, 7, ["P2=P2+1", "P3=P3+1"])
+
+        self.assertEqual(parser.lexer.blocks, PMACParser(parser.lines).lexer.blocks)
+        self.assertEqual(parser.parse({"P1": 0})["P3"], 3)
+
+    def test_parse_many(self):
+
+        lines = []
+        lines.append("Q1=P1*2")
+        lines.append("IF(P1>1)")
+        lines.append("Q2=P2+1")
+        lines.append("ELSE")
+        lines.append("Q2=-1")
+        lines.append("ENDIF")
+        lines.append("P10=0")
+        lines.append("WHILE(P10<P1)")
+        lines.append("P10=P10+1")
+        lines.append("ENDW")
+
+        parser = PMACParser(lines)
+        input_dicts = [{"P1": 0}, {"P1": 2, "P2": 5.5, "X": "tag"}, {"P1": 3.0}, {"P1": np.array([1.0, 2.0])}]
+
+        output_dicts = parser.parse_many(input_dicts)
+
+        self.assertEqual(len(output_dicts), 4)
+        for input_dict, output_dict in zip(input_dicts[:3], output_dicts):
+            self.assertEqual(output_dict, parser.parse(input_dict))
+            self.assertIs(type(output_dict["Q1"]), float)
+        np.testing.assert_array_equal(output_dicts[3]["Q2"], [-1, 1])
+
+        output_columns = parser.parse_many(input_dicts[:3], columnar=True)
+
+        np.testing.assert_array_equal(output_columns["P2"], [0, 5.5, 0])
+        np.testing.assert_array_equal(output_columns["Q2"], [-1, 6.5, 1])
+        np.testing.assert_array_equal(output_columns["P10"], [0, 2, 3])
+        self.assertEqual(parser.parse_many([]), [])
+        self.assertRaises(ValueError, parser.parse_many, input_dicts, columnar=True)
+
+    def test_parse_many_indirect(self):
+
+        parser = PMACParser(["P(P1)=P2*2"])
+
+        output_dicts = parser.parse_many([{"P1": 10, "P2": 1}, {"P1": 11, "P2": 2}])
+
+        self.assertEqual(output_dicts[0]["P10"], 2)
+        self.assertEqual(output_dicts[1]["P11"], 4)
+        self.assertNotIn("P11", output_dicts[0])
+
+    def test_parse_chunked(self):
+
+        lines = []
+        lines.append("Q1=P1*2+P3")
+        lines.append("IF(P1>4)")
+        lines.append("P2=7")
+        lines.append("ENDIF")
+
+        parser = PMACParser(lines)
+        input_dict = {"P1": np.arange(10.0), "P2": np.zeros(10), "P3": 1}
+        expected = parser.parse(input_dict, branches=BRANCH_MASKED)
+        q1 = np.zeros(10)
+
+        output_arrays = parser.parse_chunked(input_dict, outputs={"Q1": q1}, chunk_size=3)
+
+        self.assertIs(output_arrays["Q1"], q1)
+        np.testing.assert_array_equal(q1, expected["Q1"])
+        np.testing.assert_array_equal(output_arrays["P2"], expected["P2"])
+        self.assertEqual(sorted(output_arrays), ["P2", "Q1"])
+        self.assertRaises(ValueError, parser.parse_chunked, {"P1": 1})
+        self.assertRaises(ValueError, parser.parse_chunked, input_dict, outputs={"Q1": np.zeros(5)})
+
+    def test_parse_chunked_memmap(self):
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        p1 = np.lib.format.open_memmap(os.path.join(directory, "P1.npy"), mode="w+", dtype=float, shape=(100,))
+        p1[:] = np.linspace(0, 1, 100)
+
+        parser = PMACParser(["IF(P1>0.5)", "Q1=P1*2", "ELSE", "Q1=-1", "ENDIF"])
+        output_arrays = parser.parse_chunked({"P1": p1}, directory=directory, chunk_size=16)
+
+        self.assertIsInstance(output_arrays["Q1"], np.memmap)
+        np.testing.assert_array_equal(np.load(os.path.join(directory, "Q1.npy")),
+                                      np.where(p1 > 0.5, p1 * 2, -1))
 
     def test_multiple_runs(self):
         input_dict = {"P1": 42}
@@ -2090,6 +2432,131 @@ class TestParser(unittest.TestCase):
         self.assertAlmostEqual(output_dict["Q3"], 0.508241199)
         self.assertEqual(output_dict["Q8"], 306)
 
+    def test_compile(self):
+
+        input_dict = {"P1": 2, "P2": 5, "P3": 0, "I15": 1}
+
+        lines = []
+        lines.append("Q1=P(4800+1)*2+P1")
+        lines.append("WHILE(P1<10)")
+        lines.append("P1=P1+1")
+        lines.append("IF(P1%2=0)")
+        lines.append("P3=P3+SIN(P1)")
+        lines.append("ELSE")
+        lines.append("P(P2)=P2&3|8")
+        lines.append("ENDIF")
+        lines.append("ENDWHILE")
+        lines.append("Q2=-ATAN2(P1)")
+
+        parser = PMACParser(lines)
+
+        kin = parser.compile()
+
+        self.assertIn("def kin(P, Q, I, M):", kin.source)
+
+        output_dict = kin(input_dict)
+        expected_dict = parser.parse(input_dict)
+
+        self.assertEqual(sorted(output_dict), sorted(expected_dict))
+        for key in expected_dict:
+            self.assertAlmostEqual(output_dict[key], expected_dict[key])
+        self.assertEqual(output_dict["P1"], 10)
+        self.assertEqual(output_dict["P5"], 9)
+        self.assertEqual(input_dict["P1"], 2)
+
+    def test_compile_numpy(self):
+
+        p1 = np.array([1, 2, 3, 4])
+
+        input_dict = {"P1": p1}
+
+        lines = []
+        lines.append("Q1=SQRT(P1)+4")
+        lines.append("IF(Q1>0)")
+        lines.append("Q2=1")
+        lines.append("ENDIF")
+
+        parser = PMACParser(lines)
+
+        output_dict = parser.compile()(input_dict)
+
+        self.assertEqual(len(output_dict), 3)
+        self.assertTrue(np.allclose(output_dict["Q1"], np.sqrt(p1) + 4))
+        self.assertEqual(output_dict["Q2"], 1)
+
+    def test_compile_backends_agree(self):
+
+        lines = []
+        lines.append("Q1=7/2")
+        lines.append("Q2=ABS(-3)")
+        lines.append("Q3=INT(7/2)")
+
+        parser = PMACParser(lines)
+
+        for output_dict in (parser.parse({"P1": 1}), parser.parse({"P1": np.array([1, 2])}),
+                            parser.compile()({"P1": 1}), parser.compile(scalar=True)({"P1": 1})):
+            self.assertEqual([output_dict[key] for key in ("Q1", "Q2", "Q3")], [3.5, 3, 3])
+
+        output_dict = parser.compile()({"P1": 1})
+        for key in ("Q1", "Q2", "Q3"):
+            self.assertIs(type(output_dict[key]), np.float64)
+
+    def test_compile_error(self):
+
+        lines = []
+        lines.append("Q1=3")
+        lines.append("ENDIF")
+
+        parser = PMACParser(lines)
+
+        self.assertRaises(ParserError, parser.compile)
+
+    def test_compile_scalar(self):
+
+        input_dict = {"P1": 2, "P2": 5.5, "I15": 0}
+
+        lines = []
+        lines.append("Q1=SIN(P2)*COS(P1)+ATAN2(P2)")
+        lines.append("Q2=INT(P2)+ABS(-P1)")
+        lines.append("Q3=P2|P1")
+        lines.append("IF(P1=2 AND P2>5 OR P1=0)")
+        lines.append("Q4=LN(P2)")
+        lines.append("ENDIF")
+
+        parser = PMACParser(lines)
+
+        kin = parser.compile(scalar=True)
+
+        self.assertIn("_math.sin(", kin.source)
+
+        output_dict = kin(input_dict)
+        expected_dict = parser.compile()(input_dict)
+
+        self.assertEqual(sorted(output_dict), sorted(expected_dict))
+        for key in expected_dict:
+            self.assertAlmostEqual(output_dict[key], expected_dict[key])
+        self.assertIs(type(output_dict["Q1"]), float)
+        self.assertEqual(output_dict["Q2"], 7)
+        self.assertEqual(output_dict["Q3"], 7)
+
+    def test_scalar_fallback(self):
+
+        input_dict = {"P1": 0, "P2": -1}
+
+        lines = []
+        lines.append("Q1=1/P1")
+        lines.append("Q2=SQRT(P2)")
+
+        parser = PMACParser(lines)
+
+        self.assertRaises(ZeroDivisionError, parser.compile(scalar=True), input_dict)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            output_dict = parser.parse(input_dict)
+
+        self.assertEqual(output_dict["Q1"], np.inf)
+        self.assertTrue(np.isnan(output_dict["Q2"]))
+
     def test_numpy_add(self):
         p1 = np.array([1, 2, 3, 4])
 
@@ -2647,6 +3114,55 @@ class TestParser(unittest.TestCase):
 
         self.assertRaises(Exception, parser.parse, input_dict)
 
+    def test_numpy_if_masked(self):
+
+        p1 = np.array([42, 45, 40])
+
+        input_dict = {"P1": p1, "P3": 7}
+
+        lines = []
+        lines.append("Q1=1")
+        lines.append("IF(P1<43)")
+        lines.append("P2=222")
+        lines.append("ELSE")
+        lines.append("P2=P1*2")
+        lines.append("P3=333")
+        lines.append("ENDIF")
+        lines.append("Q2=2")
+
+        parser = PMACParser(lines)
+
+        output_dict = parser.parse(input_dict, branches=BRANCH_MASKED)
+
+        self.assertEqual(len(output_dict), 5)
+        self.assertEqual(list(output_dict["P2"]), [222, 90, 222])
+        self.assertEqual(list(output_dict["P3"]), [7, 333, 7])
+        self.assertEqual(output_dict["Q1"], 1)
+        self.assertEqual(output_dict["Q2"], 2)
+
+    def test_numpy_if_masked_nested(self):
+
+        p1 = np.array([1, 2, 3, 4])
+
+        input_dict = {"P1": p1}
+
+        lines = []
+        lines.append("IF(P1>1)")
+        lines.append("IF(P1<4)")
+        lines.append("Q1=SQRT(P1-2)")
+        lines.append("ELSE")
+        lines.append("Q1=10")
+        lines.append("ENDIF")
+        lines.append("ELSE")
+        lines.append("Q1=-1")
+        lines.append("ENDIF")
+
+        parser = PMACParser(lines)
+
+        output_dict = parser.parse(input_dict, branches=BRANCH_MASKED)
+
+        self.assertEqual(list(output_dict["Q1"]), [-1, 0, 1, 10])
+
     def test_numpy_while_all_true(self):
 
         p1 = np.array([20, 40])
@@ -2700,6 +3216,137 @@ class TestParser(unittest.TestCase):
 
         self.assertRaises(Exception, parser.parse, input_dict)
 
+    def test_numpy_while_masked(self):
+
+        p1 = np.array([20, 40])
+        p3 = np.array([1, 2])
+
+        input_dict = {"P1": p1, "P2": 2, "P3": p3}
+
+        lines = []
+        lines.append("Q1=1")
+        lines.append("WHILE(P3<10)")
+        lines.append("P1=P1+1")
+        lines.append("P2=P2+2")
+        lines.append("P3=P3+1")
+        lines.append("ENDWHILE")
+        lines.append("Q2=Q1+1")
+
+        parser = PMACParser(lines)
+
+        output_dict = parser.parse(input_dict, branches=BRANCH_MASKED)
+
+        self.assertEqual(len(output_dict), 5)
+        self.assertEqual(list(output_dict["P1"]), [29, 48])
+        self.assertEqual(list(output_dict["P2"]), [20, 18])
+        self.assertEqual(list(output_dict["P3"]), [10, 10])
+        self.assertEqual(output_dict["Q2"], 2)
+
+    def test_numpy_while_masked_newton(self):
+
+        p1 = np.array([2.0, 81.0, 1e6])
+
+        input_dict = {"P1": p1}
+
+        lines = []
+        # Square root by Newton's method, needing a different number of steps for each element
+        lines.append("Q1=P1")
+        lines.append("Q2=0")
+        lines.append("Q3=0")
+        lines.append("WHILE(ABS(Q1*Q1-P1)>0.000001)")
+        lines.append("Q1=(Q1+P1/Q1)/2")
+        lines.append("Q3=Q3+1")
+        lines.append("IF(Q3>1)")
+        lines.append("Q2=Q2+1")
+        lines.append("ENDIF")
+        lines.append("ENDWHILE")
+
+        parser = PMACParser(lines)
+
+        output_dict = parser.parse(input_dict, branches=BRANCH_MASKED)
+
+        self.assertTrue(np.allclose(output_dict["Q1"], np.sqrt(p1)))
+        self.assertEqual(len(set(output_dict["Q3"])), 3)
+        self.assertTrue(np.all(output_dict["Q2"] == output_dict["Q3"] - 1))
+
+    def test_numpy_if_partitioned(self):
+
+        p1 = np.array([42, 45, 40])
+
+        input_dict = {"P1": p1, "P3": 7}
+
+        lines = []
+        lines.append("IF(P1<43)")
+        lines.append("P2=222")
+        lines.append("ELSE")
+        lines.append("P2=P1*2")
+        lines.append("P3=333")
+        lines.append("ENDIF")
+
+        parser = PMACParser(lines)
+
+        output_dict = parser.parse(input_dict, branches=BRANCH_PARTITIONED)
+
+        self.assertEqual(len(output_dict), 3)
+        self.assertEqual(list(output_dict["P1"]), [42, 45, 40])
+        self.assertEqual(list(output_dict["P2"]), [222, 90, 222])
+        self.assertEqual(list(output_dict["P3"]), [7, 333, 7])
+
+    def test_numpy_branches_agree(self):
+
+        p1 = np.linspace(-5, 5, 101)
+        p2 = np.arange(101) % 7
+
+        input_dict = {"P1": p1, "P2": p2, "Q10": 3}
+
+        lines = []
+        lines.append("Q1=0")
+        lines.append("IF(P1>0)")
+        lines.append("Q1=SQRT(P1)")
+        lines.append("IF(P2<3)")
+        lines.append("Q2=ATAN2(P1)")
+        lines.append("ELSE")
+        lines.append("Q2=LN(P1)")
+        lines.append("ENDIF")
+        lines.append("ELSE")
+        lines.append("WHILE(P2>0)")
+        lines.append("Q1=Q1+P1")
+        lines.append("P2=P2-1")
+        lines.append("ENDWHILE")
+        lines.append("ENDIF")
+        lines.append("Q3=Q1+Q10")
+
+        parser = PMACParser(lines)
+
+        expected = [parser.parse({"P1": p1[i], "P2": p2[i], "Q10": 3}) for i in range(len(p1))]
+
+        for branches in (BRANCH_MASKED, BRANCH_PARTITIONED, BRANCH_AUTO):
+            output_dict = parser.parse(input_dict, branches=branches)
+            for key in ("P2", "Q1", "Q2", "Q3"):
+                self.assertTrue(np.allclose(output_dict[key], [e.get(key, 0) for e in expected]), (branches, key))
+
+    def test_branch_costs(self):
+
+        condition = Comparison("<", Variable("P", 1), Constant(43))
+        then_block = [Assignment(Variable("P", 2), Constant(222))]
+        else_block = [Assignment(Variable("P", 2), BinaryOperation("*", Variable("P", 1), Constant(2)))]
+
+        node = If(condition, then_block, else_block)
+
+        self.assertEqual((node.then_cost, node.else_cost), (3, 5))
+        self.assertEqual(pickle.loads(pickle.dumps(node)), node)
+        self.assertEqual(repr(node), "If(%r, %r, %r)" % (condition, tuple(then_block), tuple(else_block)))
+
+        variables = Variables()
+        variables.populate_with_dict({"P1": np.array([42, 45, 40]), "P3": 7})
+        self.assertEqual(variables.array_count(), 1)
+        variables.set_p_variable(2, np.array([1, 2, 3]))
+        variables.set_p_variable(1, 4)
+        self.assertEqual(variables.array_count(), 1)
+        self.assertEqual(variables.partition(np.array([True, False, True])).array_count(), 1)
+        variables.clear()
+        self.assertEqual(variables.array_count(), 0)
+
     def test_real_example2_numpy(self):
 
         p1 = np.array([21, 41])
@@ -2828,5 +3475,415 @@ class TestParser(unittest.TestCase):
         self.assertEqual(output_dict["Q8"][1], 526)
 
 
+class TestVariables(unittest.TestCase):
+
+    def test_banks(self):
+
+        variables = Variables()
+        variables.populate_with_dict({"P4801": 3, "Q1": 4, "I15": 1, "M100": 5, "X1": 6})
+
+        self.assertEqual(variables.p_variables[4801], 3)
+        self.assertEqual(variables.get_q_variable(1), 4)
+        self.assertEqual(variables.get_i_variable(15), 1)
+        self.assertEqual(variables.get_m_variable(100), 5)
+        self.assertEqual(variables.get_p_variable(8191), 0)
+
+        variables.set_p_variable(2, 7)
+
+        self.assertEqual(variables.to_dict(), {"P2": 7, "P4801": 3, "Q1": 4, "I15": 1, "M100": 5, "X1": 6})
+
+        variables.populate_with_dict({"P1": 1})
+
+        self.assertEqual(variables.to_dict(), {"P1": 1})
+        self.assertEqual(variables.get_p_variable(2), 0)
+
+    def test_converted_once(self):
+
+        p2 = np.array([1, 2, 3])
+        input_dict = {"P1": 42, "P2": p2}
+
+        variables = Variables()
+        variables.populate_with_dict(input_dict)
+
+        self.assertIsInstance(variables.get_p_variable(1), float)
+        self.assertIs(variables.get_p_variable(1), variables.get_p_variable(1))
+        self.assertEqual(variables.get_p_variable(2).dtype, float)
+        self.assertIs(variables.get_p_variable(2), variables.get_p_variable(2))
+
+        variables.set_p_variable(3, 5)
+
+        self.assertIsInstance(variables.get_p_variable(3), float)
+
+        output_dict = variables.to_dict()
+
+        self.assertIs(output_dict["P1"], input_dict["P1"])
+        self.assertIs(output_dict["P2"], p2)
+        self.assertEqual(output_dict["P3"], 5)
+
+    def test_parser_import(self):
+
+        from pmacparser.pmac_parser import Variables as ParserVariables
+
+        self.assertIs(ParserVariables, Variables)
+
+    def test_input_copied(self):
+
+        p1 = np.array([1.0, 2.0])
+        parser = PMACParser(["Q1=P1"])
+
+        for output_dict in [parser.parse({"P1": p1}), parser.compile()({"P1": p1})]:
+            self.assertIsNot(output_dict["Q1"], p1)
+            output_dict["Q1"][0] = 5
+
+        np.testing.assert_array_equal(p1, [1, 2])
+
+    def test_coordinate_systems(self):
+
+        variables = Variables()
+        variables.populate_with_dict({"Q1": 1})
+        variables.select_coordinate_system(2)
+
+        self.assertEqual(variables.get_q_variable(1), 0)
+
+        variables.set_q_variable(1, 2)
+        variables.select_coordinate_system(1)
+
+        self.assertEqual(variables.get_q_variable(1), 1)
+        self.assertEqual(variables.q_variables[2][1], 2)
+
+    def test_out_of_range(self):
+
+        lines = []
+        lines.append("P(P1)=1")
+
+        parser = PMACParser(lines)
+
+        self.assertRaises(IndexError, parser.parse, {"P1": -1})
+        self.assertRaises(IndexError, parser.parse, {"P1": 8192})
+
+
+class TestLexer(unittest.TestCase):
+
+    def test_tokens(self):
+
+        lines = []
+        lines.append("q1=p(4800+1)*2.5 ; comment")
+        lines.append("")
+        lines.append("IF(Q1!>ATAN2(3))LOCK")
+
+        lexer = PmacLexer()
+        lexer.lex(lines)
+
+        self.assertEqual([token.text for token in lexer.lexed_tokens],
+                         ["Q", "1", "=", "P", "4801", "*", "2.5",
+                          "IF", "(", "Q", "1", "!>", "ATAN2", "(", "3", ")", ")", "LOCK"])
+        self.assertEqual([token.line for token in lexer.lexed_tokens], [1] * 7 + [3] * 11)
+
+    def test_numbers(self):
+
+        lexer = PmacLexer()
+        lexer.lex(["Q1=2.5*P(4800+1)+2.5", "Q2=2"])
+
+        values = [token.value for token in lexer.lexed_tokens if token.is_float()]
+
+        self.assertEqual(values, [1, 2.5, 4801, 2.5, 2, 2])
+        self.assertIs(type(values[0]), int)
+        self.assertIs(type(values[1]), float)
+        self.assertEqual(lexer.texts.count("2.5"), 1)
+
+    def test_text(self):
+
+        lines = []
+        lines.append("  q1=p1*2 ; comment")
+        lines.append("")
+        lines.append("IF (Q1 > 2)\t")
+        lines.append("\tQ2=(4800+1)")
+        lines.append("ENDIF ")
+
+        expected = PmacLexer()
+        expected.lex(lines)
+
+        text = u"\n".join(lines)
+        sources = ["\n".join(lines), text, "\r\n".join(lines).encode(), io.StringIO(text + u"\n")]
+        for source in sources:
+            lexer = PmacLexer()
+            lexer.lex(source)
+
+            self.assertEqual([(token.text, token.line) for token in lexer.lexed_tokens],
+                             [(token.text, token.line) for token in expected.lexed_tokens])
+            self.assertEqual(lexer.blocks, expected.blocks)
+
+    def test_parser_file(self):
+
+        parser = PMACParser(io.BytesIO(b"Q1=P1+1 ; add one\nQ2=Q1*2\n"))
+
+        output_dict = parser.parse({"P1": 1})
+
+        self.assertEqual(output_dict["Q1"], 2)
+        self.assertEqual(output_dict["Q2"], 4)
+
+    def test_unrecognised_token(self):
+
+        lexer = PmacLexer()
+
+        self.assertRaises(Exception, lexer.lex, ["Q1=P1", "Q2=P1#2"])
+
+    def test_line_cache(self):
+
+        line_cache = LineCache(size=2)
+        lines = ["Q1=P1*2 ; scale", "q1=p1*2", "Q2=P(4800+1)", "Q1=P1*2"]
+
+        lexer = PmacLexer(line_cache)
+        lexer.lex(lines)
+        expected = PmacLexer()
+        expected.lex(lines)
+
+        self.assertEqual([(token.text, token.line, token.kind, token.value) for token in lexer.lexed_tokens],
+                         [(token.text, token.line, token.kind, token.value) for token in expected.lexed_tokens])
+        self.assertEqual((line_cache.hits, line_cache.misses), (2, 2))
+
+        PmacLexer(line_cache).lex(["Q3=1", "Q1=P1*2"])
+
+        self.assertEqual((line_cache.hits, line_cache.misses), (3, 3))
+        self.assertEqual(list(line_cache.entries), ["Q3=1", "Q1=P1*2"])
+
+    def test_highlight(self):
+
+        from pygments.token import Comment, Keyword, Name
+
+        tokens = list(highlight_lexer().get_tokens("Q1=SIN(P2) ; comment\n"))
+
+        self.assertIn((Name.VariableQ, "Q"), tokens)
+        self.assertIn((Keyword.Math, "SIN"), tokens)
+        self.assertIn((Comment.Single, "; comment"), tokens)
+
+    def test_no_pygments(self):
+
+        code = "import sys, pmacparser.pmac_parser; print('pygments' in sys.modules)"
+
+        output = subprocess.check_output([sys.executable, "-c", code])
+
+        self.assertEqual(output.strip(), b"False")
+
+
+class TestBackup(unittest.TestCase):
+
+    backup = "\r\n".join([
+        "I100=1",
+        "&2",
+        "OPEN FORWARD",
+        "CLEAR",
+        "Q1=P1*2 ; scale",
+        "Q2=P2",
+        "CLOSE",
+        "OPEN PROG 10 CLEAR",
+        "&3 X10",
+        "CLOSE",
+        "&2 OPEN INVERSE CLEAR",
+        "P1=Q1/2",
+        "CLOSE",
+        "OPEN PLC 5 CLEAR",
+        "IF(P10=1)",
+        "P11=P11+1",
+        "ENDIF",
+        "CLOSE",
+        "I200=2",
+    ]) + "\r\n"
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "backup.pmc")
+        with open(self.path, "wb") as backup_file:
+            backup_file.write(self.backup.encode())
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_programs(self):
+
+        programs = list(BackupFile(self.path).programs())
+
+        self.assertEqual([program.key for program in programs], [(FORWARD, 2), (INVERSE, 2), (PLC, 5)])
+        self.assertEqual(programs[0].lines, ["Q1=P1*2 ; scale", "Q2=P2"])
+        self.assertEqual(programs[0].line, 5)
+        self.assertEqual(programs[2].lines, ["IF(P10=1)", "P11=P11+1", "ENDIF"])
+
+        output_dict = programs[0].parser().parse({"P1": 3, "P2": 4})
+
+        self.assertEqual(output_dict["Q1"], 6)
+        self.assertEqual(output_dict["Q2"], 4)
+
+    def test_index(self):
+
+        backup = BackupFile(self.path)
+        programs = dict((program.key, program) for program in backup.programs())
+
+        self.assertEqual(list(backup.index), [(FORWARD, 2), (INVERSE, 2), (PLC, 5)])
+
+        for key, program in programs.items():
+            reread = BackupFile(self.path)
+            reread.index = backup.index
+            program_block = reread.read_program(*key)
+
+            self.assertEqual(program_block.lines, program.lines)
+            self.assertEqual(program_block.line, program.line)
+
+    def test_mapped(self):
+
+        programs = list(BackupFile(self.path).programs())
+
+        with MappedBackupFile(self.path) as backup:
+            mapped_programs = list(backup.programs())
+
+            self.assertEqual([program.key for program in mapped_programs], [program.key for program in programs])
+            for program, mapped_program in zip(programs, mapped_programs):
+                self.assertIsNone(mapped_program.lines)
+                self.assertEqual((mapped_program.line, mapped_program.offset, mapped_program.length),
+                                 (program.line, program.offset, program.length))
+
+            output_dict = backup.read_program(FORWARD, 2).parser().parse({"P1": 3, "P2": 4})
+
+            self.assertEqual(output_dict["Q1"], 6)
+            self.assertEqual(output_dict["Q2"], 4)
+
+
+class TestPersistentCache(unittest.TestCase):
+
+    lines = ["Q1=P1*2", "IF(P1>1)", "Q2=SQRT(P1)", "ENDIF"]
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_load(self):
+
+        parser = PMACParser(self.lines, program_cache=PersistentProgramCache(self.directory))
+        compiled = parser.compile(scalar=True)
+
+        program_cache = PersistentProgramCache(self.directory)
+        loaded_parser = PMACParser(self.lines, program_cache=program_cache)
+
+        self.assertEqual(program_cache.loads, 1)
+        self.assertEqual(loaded_parser.statements, parser.statements)
+        self.assertEqual(loaded_parser.lexer.blocks, parser.lexer.blocks)
+        self.assertEqual(loaded_parser.program.compiled_programs[True].source, compiled.source)
+        self.assertEqual(loaded_parser.parse({"P1": 4}), parser.parse({"P1": 4}))
+
+    def test_stale(self):
+
+        PMACParser(self.lines, program_cache=PersistentProgramCache(self.directory))
+        cache_version = pmac_cache.CACHE_VERSION
+        pmac_cache.CACHE_VERSION = ("0.0", cache_version[1])
+        try:
+            program_cache = PersistentProgramCache(self.directory)
+            parser = PMACParser(self.lines, program_cache=program_cache)
+        finally:
+            pmac_cache.CACHE_VERSION = cache_version
+
+        self.assertEqual(program_cache.loads, 0)
+        self.assertEqual(parser.parse({"P1": 4})["Q2"], 2)
+
+        path = program_cache.path(parser.program_key)
+        with open(path, "wb") as cache_file:
+            cache_file.write(b"not a pickle")
+        program_cache = PersistentProgramCache(self.directory)
+        parser = PMACParser(self.lines, program_cache=program_cache)
+
+        self.assertEqual(program_cache.loads, 0)
+        self.assertEqual(parser.parse({"P1": 4})["Q2"], 2)
+
+        program_cache = PersistentProgramCache(self.directory)
+        PMACParser(self.lines, program_cache=program_cache)
+
+        self.assertEqual(program_cache.loads, 1)
+
+    def test_python_versions(self):
+
+        PMACParser(self.lines, program_cache=PersistentProgramCache(self.directory))
+        cache_version, python_tag = pmac_cache.CACHE_VERSION, pmac_cache.PYTHON_TAG
+        pmac_cache.CACHE_VERSION = (cache_version[0], "another python")
+        pmac_cache.PYTHON_TAG = "another"
+        try:
+            program_cache = PersistentProgramCache(self.directory)
+            PMACParser(self.lines, program_cache=program_cache)
+        finally:
+            pmac_cache.CACHE_VERSION, pmac_cache.PYTHON_TAG = cache_version, python_tag
+
+        self.assertEqual(program_cache.loads, 0)
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+
+        program_cache = PersistentProgramCache(self.directory)
+        PMACParser(self.lines, program_cache=program_cache)
+
+        self.assertEqual(program_cache.loads, 1)
+
+    @unittest.skipUnless(hasattr(os, "getuid"), "needs file ownership")
+    def test_untrusted(self):
+
+        parser = PMACParser(self.lines, program_cache=PersistentProgramCache(self.directory))
+        path = PersistentProgramCache(self.directory).path(parser.program_key)
+        os.chmod(path, 0o666)
+
+        program_cache = PersistentProgramCache(self.directory)
+        parser = PMACParser(self.lines, program_cache=program_cache)
+
+        self.assertEqual(program_cache.loads, 0)
+        self.assertEqual(parser.parse({"P1": 4})["Q2"], 2)
+
+        os.chmod(path, 0o600)
+        program_cache = PersistentProgramCache(self.directory)
+        PMACParser(self.lines, program_cache=program_cache)
+
+        self.assertEqual(program_cache.loads, 1)
+
+
+class TestBatch(unittest.TestCase):
+
+    programs = [
+        ["Q1=P1*2", "IF(P1>1)", "Q2=P1", "ENDIF"],
+        "Q1=P1+1\nQ2=Q1*(\nQ3=1\n",
+        b"Q1=SQRT(P1)",
+    ]
+
+    def test_pickle(self):
+
+        compiled = PMACParser(self.programs[0]).compile()
+        error = PMACParser(self.programs[1]).error
+
+        unpickled = pickle.loads(pickle.dumps(compiled))
+        unpickled_error = pickle.loads(pickle.dumps(error))
+
+        self.assertEqual(unpickled.source, compiled.source)
+        self.assertEqual(unpickled({"P1": 3}), compiled({"P1": 3}))
+        self.assertEqual(str(unpickled_error), str(error))
+        self.assertEqual(unpickled_error.line, 3)
+
+    def test_pickle_code(self):
+
+        compiled = PMACParser(self.programs[0]).compile(scalar=True)
+        # The code is unpickled without compiling the source again
+        uncompilable = CompiledProgram(None, compiled.function_name, True, "not python", compiled.code)
+
+        unpickled = pickle.loads(pickle.dumps(uncompilable))
+
+        self.assertEqual(unpickled({"P1": 3}), compiled({"P1": 3}))
+        self.assertEqual(load_compiled_program("kin", True, compiled.source, "another python", b"")({"P1": 3}),
+                         compiled({"P1": 3}))
+
+    def test_compile_programs(self):
+
+        for processes in (1, 2):
+            results = compile_programs(self.programs + [["Q1=P1#2"]], processes=processes)
+
+            self.assertEqual(results[0]({"P1": 3})["Q2"], 3)
+            self.assertIsInstance(results[1], ParserError)
+            self.assertEqual(results[1].line, 3)
+            self.assertEqual(results[2]({"P1": 4})["Q1"], 2)
+            self.assertNotIsInstance(results[3], ParserError)
+            self.assertIn("Unrecognised Token", results[3].args[0])
+
+
 if __name__ == "__main__":
     unittest.main(2)